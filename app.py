@@ -1,15 +1,23 @@
 
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file
-from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, abort, g, has_request_context, Response, stream_with_context, session as flask_session, before_render_template, template_rendered
+from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin, login_url
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import FlaskForm
 from wtforms import StringField, DecimalField, IntegerField, TextAreaField, DateField, SelectField
 from wtforms.validators import DataRequired, Optional, NumberRange
-import csv, io, os, datetime
+import csv, io, os, re, datetime, time, json, threading, functools, base64, codecs, hashlib, random, tempfile, shutil, sqlite3, tracemalloc, math, secrets
+from urllib.parse import quote
+import click
+from collections import namedtuple, OrderedDict, Counter
+from array import array
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
-from sqlalchemy import or_
+from sqlalchemy import or_, and_, union_all, select, insert, update, delete, func, event, tuple_, text, inspect, cast, exists, literal, null, case, false, create_engine
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload, contains_eager, aliased, object_session
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///inventory.db')
@@ -26,17 +34,96 @@ db_url = os.getenv('DATABASE_URL', 'sqlite:////tmp/inventory.db')
 app.config['SQLALCHEMY_DATABASE_URI'] = db_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# Creazione delle tabelle al primo avvio
-from app import db  # se questa riga dà errore, la sposto io
-with app.app_context():
-    db.create_all()
-
 # Health check (per confermare che l'app è avviata)
 @app.route('/health')
 def health():
     return 'ok', 200
 
-
+# --- Database engine profile ---
+# SQLite: WAL lets readers run while a writer commits and busy_timeout makes
+# a writer wait for the lock instead of failing with "database is locked".
+# PostgreSQL: the pool is sized to the gunicorn threads, with pre-ping and
+# recycle for connections dropped by the server. Both use TimedQueuePool so
+# checkout waits can be watched on /health/pool while tuning.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', os.getenv('GUNICORN_THREADS', '8')))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '2'))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+# operational endpoints: scrapers send "Authorization: Bearer <METRICS_TOKEN>", anyone else logs in
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+def ops_endpoint(view):
+    protected = login_required(view)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        sent = request.headers.get('Authorization', '')
+        if METRICS_TOKEN and secrets.compare_digest(sent.encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+            return view(*args, **kwargs)
+        return protected(*args, **kwargs)
+    return wrapper
+
+_pool_lock = threading.Lock()
+_pool_stats = {'checkouts': 0, 'timeouts': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+               'buckets': [0] * (len(POOL_WAIT_BUCKETS) + 1)}
+
+def record_pool_wait(seconds, timed_out=False):
+    with _pool_lock:
+        _pool_stats['checkouts'] += 1
+        _pool_stats['timeouts'] += int(timed_out)
+        _pool_stats['wait_seconds'] += seconds
+        _pool_stats['max_wait_seconds'] = max(_pool_stats['max_wait_seconds'], seconds)
+        _pool_stats['buckets'][next((i for i, b in enumerate(POOL_WAIT_BUCKETS) if seconds <= b),
+                                    len(POOL_WAIT_BUCKETS))] += 1
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeout:
+            record_pool_wait(time.perf_counter() - started, timed_out=True)
+            raise
+        record_pool_wait(time.perf_counter() - started)
+        return conn
+
+def engine_options(url):
+    if url.startswith('sqlite'):
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            return {}
+        return {'poolclass': TimedQueuePool, 'pool_size': DB_POOL_SIZE, 'max_overflow': DB_MAX_OVERFLOW,
+                'pool_timeout': DB_POOL_TIMEOUT}
+    return {'poolclass': TimedQueuePool, 'pool_size': DB_POOL_SIZE, 'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT, 'pool_pre_ping': True, 'pool_recycle': DB_POOL_RECYCLE}
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_conn, connection_record):
+    if isinstance(dbapi_conn, sqlite3.Connection):
+        cursor = dbapi_conn.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+def pool_metrics():
+    with _pool_lock:
+        stats = dict(_pool_stats, buckets=list(_pool_stats['buckets']))
+    stats['wait_buckets'] = dict(zip([str(b) for b in POOL_WAIT_BUCKETS] + ['+Inf'], stats.pop('buckets')))
+    pool = db.engine.pool
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow(),
+                     checked_in=pool.checkedin(), max_overflow=DB_MAX_OVERFLOW)
+    return stats
+
+@app.route('/health/pool')
+@ops_endpoint
+def health_pool():
+    return jsonify(pool_metrics())
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 db = SQLAlchemy(app)
 
 login_manager = LoginManager()
@@ -76,9 +163,9 @@ class Category(db.Model):
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sku = db.Column(db.String(64), unique=True, nullable=False)
-    name = db.Column(db.String(200), nullable=False)
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
-    supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'))
+    name = db.Column(db.String(200), nullable=False, index=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), index=True)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'), index=True)
     unit = db.Column(db.String(32), default='pezzi')
     vat = db.Column(db.Integer, default=10)  # % IVA
     cost = db.Column(db.Float, default=0.0)
@@ -92,6 +179,12 @@ class Product(db.Model):
     supplier_ref = db.relationship('Supplier', back_populates='products')
     category_ref = db.relationship('Category', back_populates='products')
 
+    __table_args__ = (
+        db.Index('ix_product_low_stock', 'min_stock', 'stock_qty',
+                 sqlite_where=text('min_stock > 0 AND stock_qty <= min_stock'),
+                 postgresql_where=text('min_stock > 0 AND stock_qty <= min_stock')),
+    )
+
 class PriceList(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
@@ -110,16 +203,164 @@ class PriceListItem(db.Model):
     price_list = db.relationship('PriceList', back_populates='items')
     product = db.relationship('Product', back_populates='prices')
 
+    __table_args__ = (
+        db.Index('ux_price_list_item_list_product', 'price_list_id', 'product_id', unique=True),
+    )
+
 class Lot(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)  # ix_lot_product_expiry
     lot_code = db.Column(db.String(120), nullable=False)
-    expiry_date = db.Column(db.Date, nullable=True)
+    expiry_date = db.Column(db.Date, nullable=True, index=True)
     qty = db.Column(db.Integer, default=0)
     notes = db.Column(db.Text)
 
     product = db.relationship('Product', back_populates='lots')
 
+    __table_args__ = (
+        db.Index('ix_lot_product_expiry', 'product_id', 'expiry_date'),
+        # ids are never reused: the ledger and lot_archive keep referring to deleted lots
+        {'sqlite_autoincrement': True},
+    )
+
+class LotArchive(db.Model):
+    # Expired or emptied lots moved out of `lot` by archive-lots; same id as the original lot.
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    product_id = db.Column(db.Integer, nullable=False, index=True)  # no FK, like stock_movement
+    lot_code = db.Column(db.String(120), nullable=False)
+    expiry_date = db.Column(db.Date, nullable=True, index=True)
+    qty = db.Column(db.Integer, default=0)  # quantity when archived, written off with an 'expire' movement
+    notes = db.Column(db.Text)
+    reason = db.Column(db.String(16), nullable=False)  # expired/empty
+    archived_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class StockMovement(db.Model):
+    # Append-only ledger; no foreign keys so the history outlives deleted products and lots.
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False, index=True)
+    lot_id = db.Column(db.Integer, index=True)
+    kind = db.Column(db.String(16), nullable=False)  # load/unload/adjust/expire
+    qty = db.Column(db.Integer, nullable=False)  # signed delta
+    reason = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class SchemaVersion(db.Model):
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(200))
+    applied_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class StatCounter(db.Model):
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class ExpiryBucket(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    lots = db.Column(db.Integer, nullable=False, default=0)
+
+class ChangeLog(db.Model):
+    seq = db.Column(db.Integer, primary_key=True)  # insertion order
+    entity = db.Column(db.String(32), nullable=False)  # table name
+    row_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(1), nullable=False)  # I/U/D
+    changed_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    feed_seq = db.Column(db.BigInteger)  # commit order, set by sequence_changes() once committed
+
+    __table_args__ = (
+        db.Index('ux_change_log_feed_seq', 'feed_seq', unique=True),
+        {'sqlite_autoincrement': True},  # never reuse a sequence number
+    )
+
+class TableVersion(db.Model):
+    name = db.Column(db.String(64), primary_key=True)  # table name
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class ValuationSnapshot(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    dimension = db.Column(db.String(16), primary_key=True)  # total/category/supplier
+    key = db.Column(db.String(200), primary_key=True)  # category/supplier name, '' for total or unassigned
+    products = db.Column(db.Integer, default=0)
+    stock_qty = db.Column(db.Integer, default=0)
+    stock_cost = db.Column(db.Float, default=0.0)
+    stock_value = db.Column(db.Float, default=0.0)
+    stock_value_vat = db.Column(db.Float, default=0.0)
+    expiring_days = db.Column(db.Integer, default=30)
+    expiring_qty = db.Column(db.Integer, default=0)
+    expiring_cost = db.Column(db.Float, default=0.0)
+    expiring_value = db.Column(db.Float, default=0.0)
+
+class PurchaseProposal(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'), index=True)  # NULL: products without supplier
+    status = db.Column(db.String(16), nullable=False, default='draft', index=True)  # draft/sent
+    lead_days = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    lines = db.Column(db.Integer, default=0)
+    total_qty = db.Column(db.Integer, default=0)
+    total_cost = db.Column(db.Float, default=0.0)
+
+    supplier_ref = db.relationship('Supplier')
+    items = db.relationship('PurchaseProposalLine', back_populates='proposal', cascade="all, delete-orphan")
+
+class PurchaseProposalLine(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    proposal_id = db.Column(db.Integer, db.ForeignKey('purchase_proposal.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, nullable=False, index=True)  # no FK: sent orders outlive the product
+    stock_qty = db.Column(db.Integer, default=0)
+    min_stock = db.Column(db.Integer, default=0)
+    expiring_qty = db.Column(db.Integer, default=0)
+    on_order_qty = db.Column(db.Integer, default=0)
+    qty = db.Column(db.Integer, nullable=False)
+    unit_cost = db.Column(db.Float, default=0.0)
+    line_cost = db.Column(db.Float, default=0.0)
+
+    proposal = db.relationship('PurchaseProposal', back_populates='items')
+
+class ApiToken(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)  # sha256 hex, the token itself is never stored
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    last_used_at = db.Column(db.DateTime)
+    revoked_at = db.Column(db.DateTime)
+
+    user = db.relationship('User')
+
+class RenderedDocument(db.Model):
+    key = db.Column(db.String(255), primary_key=True)  # e.g. pricelist:3
+    content_hash = db.Column(db.String(64), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class ImportRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255))
+    status = db.Column(db.String(16), default='running')  # running/done/failed
+    rows_done = db.Column(db.Integer, default=0)
+    rows_rejected = db.Column(db.Integer, default=0)
+    last_offset = db.Column(db.Integer, default=0)  # CSV data rows committed so far
+    error = db.Column(db.Text)
+    started_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.String(16), default='queued', index=True)  # queued/running/done/failed
+    params = db.Column(db.Text)  # JSON
+    payload = db.Column(db.LargeBinary)  # uploaded file, dropped when the job ends
+    result = db.Column(db.LargeBinary)
+    result_name = db.Column(db.String(255))
+    result_mimetype = db.Column(db.String(100))
+    message = db.Column(db.String(500))
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    lease_until = db.Column(db.DateTime)  # renewed by the worker while running
+
 # --- Forms ---
 class SupplierForm(FlaskForm):
     name = StringField('Ragione sociale', validators=[DataRequired()])
@@ -177,11 +418,994 @@ def safe_float(x, default=0.0):
     except:
         return default
 
+def safe_int(x, default=0):
+    try:
+        return int(x)
+    except:
+        return default
+
+def chunked(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
+
+# CSV exports are streamed: rows are fetched with yield_per (server-side
+# cursor on Postgres) and written out in batches behind a UTF-8 BOM.
+EXPORT_BATCH_ROWS = int(os.getenv('EXPORT_BATCH_ROWS', '1000'))
+
+def attachment_header(filename):
+    ascii_name = filename.encode('ascii', 'ignore').decode().replace('"', '') or 'export'
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+def stream_csv(filename, header, rows):
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(header)
+        yield codecs.BOM_UTF8 + buf.getvalue().encode('utf-8')
+        buf.seek(0)
+        buf.truncate()
+        for n, row in enumerate(rows, start=1):
+            writer.writerow(row)
+            if n % EXPORT_BATCH_ROWS == 0:
+                yield buf.getvalue().encode('utf-8')
+                buf.seek(0)
+                buf.truncate()
+        if buf.tell():
+            yield buf.getvalue().encode('utf-8')
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': attachment_header(filename)})
+
+def dialect_insert(table):
+    # INSERT supporting .on_conflict_do_update(), or None when the database has no native upsert
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as upsert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    else:
+        return None
+    return upsert(table)
+
+# --- Queries ---
+# Each builder eager-loads exactly the relationships its views render, so
+# listings and exports run in a constant number of queries.
+def product_list_query():
+    return Product.query.options(joinedload(Product.category_ref), joinedload(Product.supplier_ref))
+
+def pricelist_items_query(lid):
+    return (PriceListItem.query.join(PriceListItem.product)
+            .filter(PriceListItem.price_list_id == lid)
+            .options(contains_eager(PriceListItem.product))
+            .order_by(func.lower(Product.name).asc(), PriceListItem.id.asc()))
+
+# --- Search ---
+# Full-text index over product (sku, name) and supplier (name, email, phone):
+# FTS5 external-content tables kept in sync by triggers on SQLite, generated
+# tsvector columns on Postgres. Without an index (other databases, or before
+# `flask init-db`) searches fall back to ILIKE.
+# The indexes match word prefixes only, so a code-like query (one token with
+# a digit, e.g. "123" for "AB-0123X") also matches SUBSTRING_FIELDS anywhere
+# with ILIKE, backed by a trigram index on Postgres.
+SEARCH_FIELDS = {
+    'product': (Product, ('sku', 'name')),
+    'supplier': (Supplier, ('name', 'email', 'phone')),
+}
+SUBSTRING_FIELDS = {'product': ('sku',)}
+_search_state = {}
+
+def _sqlite_search_ddl(table, cols):
+    fts = f'{table}_fts'
+    col_list = ', '.join(cols)
+    new_vals = ', '.join(f'new.{c}' for c in cols)
+    old_vals = ', '.join(f'old.{c}' for c in cols)
+    delete_old = f"INSERT INTO {fts}({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals});"
+    insert_new = f"INSERT INTO {fts}(rowid, {col_list}) VALUES (new.id, {new_vals});"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({col_list}, content='{table}', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN {delete_old} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {col_list} ON {table} BEGIN {delete_old} {insert_new} END",
+        f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    ]
+
+def _postgres_search_ddl(table, cols):
+    doc = " || ' ' || ".join(f"coalesce({c}, '')" for c in cols)
+    return [
+        f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector "
+        f"GENERATED ALWAYS AS (to_tsvector('simple', {doc})) STORED",
+        f"CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} USING gin (search_vector)",
+    ] + _postgres_substring_ddl(table)
+
+def _postgres_substring_ddl(table):
+    cols = SUBSTRING_FIELDS.get(table, ())
+    ddl = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] if cols else []
+    return ddl + [f"CREATE INDEX IF NOT EXISTS ix_{table}_{c}_trgm ON {table} USING gin ({c} gin_trgm_ops)"
+                  for c in cols]
+
+def init_search(conn):
+    dialect = conn.dialect.name
+    for table, (model, cols) in SEARCH_FIELDS.items():
+        if dialect == 'sqlite':
+            ddl = _sqlite_search_ddl(table, cols)
+        elif dialect == 'postgresql':
+            ddl = _postgres_search_ddl(table, cols)
+        else:
+            return
+        for stmt in ddl:
+            conn.execute(text(stmt))
+    _search_state.clear()
+
+def search_backend():
+    if 'backend' not in _search_state:
+        dialect = db.engine.dialect.name
+        backend = None
+        if dialect == 'sqlite':
+            found = db.session.execute(text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='product_fts'")).scalar()
+            backend = 'fts5' if found else None
+        elif dialect == 'postgresql':
+            found = db.session.execute(text("SELECT 1 FROM information_schema.columns "
+                                            "WHERE table_name='product' AND column_name='search_vector'")).scalar()
+            backend = 'tsvector' if found else None
+        _search_state['backend'] = backend
+    return _search_state['backend']
+
+def search_terms(q):
+    return re.findall(r'\w+', q.lower())
+
+def _ranked_search(kind, q):
+    # (id, score) select for the query string, best match first
+    terms = search_terms(q)
+    if not terms:
+        return None
+    backend = search_backend()
+    if backend == 'fts5':
+        match = ' '.join(f'"{t}"*' for t in terms)
+        return text(f"SELECT rowid AS id, -bm25({kind}_fts) AS score FROM {kind}_fts "
+                    f"WHERE {kind}_fts MATCH :match ORDER BY rank").bindparams(match=match)
+    if backend == 'tsvector':
+        tsq = ' & '.join(f'{t}:*' for t in terms)
+        return text(f"SELECT id, ts_rank(search_vector, to_tsquery('simple', :tsq)) AS score FROM {kind} "
+                    f"WHERE search_vector @@ to_tsquery('simple', :tsq) ORDER BY score DESC, id").bindparams(tsq=tsq)
+    return None
+
+def _substring_match(kind, q):
+    # None unless q is code-like and the kind has substring fields
+    q = q.strip()
+    cols = SUBSTRING_FIELDS.get(kind)
+    if not cols or not re.fullmatch(r'\S*\d\S*', q):
+        return None
+    model = SEARCH_FIELDS[kind][0]
+    like = '%' + re.sub(r'([\\%_])', r'\\\1', q) + '%'
+    return or_(*[getattr(model, c).ilike(like, escape='\\') for c in cols])
+
+def search_filter(kind, q):
+    """WHERE clause restricting a Product/Supplier query to the rows matching q."""
+    model, cols = SEARCH_FIELDS[kind]
+    ranked = _ranked_search(kind, q)
+    if ranked is not None:
+        matched = model.id.in_(select(ranked.columns(id=db.Integer, score=db.Float).subquery().c.id))
+        substring = _substring_match(kind, q)
+        return matched if substring is None else or_(matched, substring)
+    like = f"%{q}%"
+    return or_(*[getattr(model, c).ilike(like) for c in cols])
+
+def search(kind, q, limit=10):
+    """Ranked matches as a list of (id, score); prefix-matches every word of q.
+
+    Substring-only matches of a code-like q follow the ranked ones with score 0.
+    """
+    model, cols = SEARCH_FIELDS[kind]
+    ranked = _ranked_search(kind, q)
+    if ranked is not None:
+        sub = ranked.columns(id=db.Integer, score=db.Float).subquery()
+        hits = db.session.execute(select(sub.c.id, sub.c.score).order_by(sub.c.score.desc(), sub.c.id).limit(limit)).all()
+        substring = _substring_match(kind, q)
+        if substring is not None and len(hits) < limit:
+            seen = [h[0] for h in hits]
+            extra = db.session.execute(select(model.id).where(substring, model.id.not_in(seen))
+                                       .order_by(model.id).limit(limit - len(hits))).scalars()
+            hits += [(rid, 0.0) for rid in extra]
+        return hits
+    rows = db.session.execute(select(model.id).where(search_filter(kind, q)).order_by(model.id).limit(limit)).scalars()
+    return [(rid, 0.0) for rid in rows]
+
+# --- Dashboard stats ---
+# Home page counters are maintained incrementally by ORM hooks; lots are
+# counted per expiry day so "expiring within N days" is a sum over few rows.
+# Bulk Core writes bypass the hooks, so a full recompute runs after imports,
+# whenever the snapshot is older than DASHBOARD_RECOMPUTE_SECONDS and from
+# `flask recompute-stats`.
+DASHBOARD_RECOMPUTE_SECONDS = int(os.getenv('DASHBOARD_RECOMPUTE_SECONDS', '3600'))
+_stats_lock = threading.Lock()
+
+def is_low_stock(stock_qty, min_stock):
+    return (min_stock or 0) > 0 and stock_qty is not None and stock_qty <= min_stock
+
+def _bump_counter(conn, name, delta):
+    if delta:
+        conn.execute(update(StatCounter.__table__).where(StatCounter.name == name)
+                     .values(value=StatCounter.value + delta))
+
+def _bump_expiry(conn, day, delta):
+    if not day or not delta:
+        return
+    table = ExpiryBucket.__table__
+    stmt = dialect_insert(table)
+    if stmt is not None:
+        conn.execute(stmt.values(day=day, lots=delta)
+                     .on_conflict_do_update(index_elements=[table.c.day], set_={'lots': table.c.lots + delta}))
+    elif not conn.execute(update(table).where(table.c.day == day).values(lots=table.c.lots + delta)).rowcount:
+        conn.execute(insert(table).values(day=day, lots=delta))
+
+def _old_value(target, attr):
+    hist = inspect(target).attrs[attr].history
+    return hist.deleted[0] if hist.deleted else getattr(target, attr)
+
+# active_history loads the previous value even when the attribute was expired by a commit
+for _attr in (Product.stock_qty, Product.min_stock, Lot.expiry_date):
+    event.listen(_attr, 'set', lambda *args: None, active_history=True)
+
+@event.listens_for(Product, 'after_insert')
+def _stats_product_insert(mapper, conn, target):
+    _bump_counter(conn, 'products', 1)
+    _bump_counter(conn, 'low_stock', int(is_low_stock(target.stock_qty, target.min_stock)))
+
+@event.listens_for(Product, 'after_delete')
+def _stats_product_delete(mapper, conn, target):
+    _bump_counter(conn, 'products', -1)
+    _bump_counter(conn, 'low_stock', -int(is_low_stock(target.stock_qty, target.min_stock)))
+
+@event.listens_for(Product, 'after_update')
+def _stats_product_update(mapper, conn, target):
+    was = is_low_stock(_old_value(target, 'stock_qty'), _old_value(target, 'min_stock'))
+    _bump_counter(conn, 'low_stock', int(is_low_stock(target.stock_qty, target.min_stock)) - int(was))
+
+@event.listens_for(PriceList, 'after_insert')
+def _stats_pricelist_insert(mapper, conn, target):
+    _bump_counter(conn, 'price_lists', 1)
+
+@event.listens_for(PriceList, 'after_delete')
+def _stats_pricelist_delete(mapper, conn, target):
+    _bump_counter(conn, 'price_lists', -1)
+
+@event.listens_for(Lot, 'after_insert')
+def _stats_lot_insert(mapper, conn, target):
+    _bump_expiry(conn, target.expiry_date, 1)
+
+@event.listens_for(Lot, 'after_delete')
+def _stats_lot_delete(mapper, conn, target):
+    _bump_expiry(conn, target.expiry_date, -1)
+
+@event.listens_for(Lot, 'after_update')
+def _stats_lot_update(mapper, conn, target):
+    old = _old_value(target, 'expiry_date')
+    if old != target.expiry_date:
+        _bump_expiry(conn, old, -1)
+        _bump_expiry(conn, target.expiry_date, 1)
+
+def recompute_dashboard_stats():
+    if not _stats_lock.acquire(blocking=False):
+        return False
+    try:
+        counters = {
+            'products': Product.query.count(),
+            'price_lists': PriceList.query.count(),
+            'low_stock': Product.query.filter(Product.stock_qty <= Product.min_stock, Product.min_stock > 0).count(),
+            'recomputed_at': int(time.time()),
+        }
+        buckets = db.session.execute(select(Lot.expiry_date, func.count(Lot.id))
+                                     .where(Lot.expiry_date != None).group_by(Lot.expiry_date)).all()
+        db.session.execute(delete(StatCounter))
+        db.session.execute(delete(ExpiryBucket))
+        db.session.execute(insert(StatCounter), [{'name': k, 'value': v} for k, v in counters.items()])
+        if buckets:
+            db.session.execute(insert(ExpiryBucket), [{'day': d, 'lots': n} for d, n in buckets])
+        db.session.commit()
+        return True
+    finally:
+        _stats_lock.release()
+
+def dashboard_stats(expiring_days=30):
+    counters = dict(db.session.execute(select(StatCounter.name, StatCounter.value)).all())
+    if time.time() - counters.get('recomputed_at', 0) > DASHBOARD_RECOMPUTE_SECONDS and recompute_dashboard_stats():
+        counters = dict(db.session.execute(select(StatCounter.name, StatCounter.value)).all())
+    soon = datetime.date.today() + datetime.timedelta(days=expiring_days)
+    counters['expiring'] = db.session.execute(select(func.coalesce(func.sum(ExpiryBucket.lots), 0))
+                                              .where(ExpiryBucket.day <= soon)).scalar()
+    return counters
+
+# --- Stock ledger ---
+# Every stock change is appended to stock_movement and applied to the product
+# (and lot) balance with an atomic `qty = qty + delta` UPDATE, so concurrent
+# movements cannot overwrite each other. Product.stock_qty is the maintained
+# balance; `flask reconcile-stock` rebuilds it from the ledger.
+MOVEMENT_KINDS = {'load': 'Carico', 'unload': 'Scarico', 'adjust': 'Rettifica', 'expire': 'Scaduto'}
+
+def log_movements(rows):
+    """Append ledger rows whose effect is already in the balances (imports, new products)."""
+    now = datetime.datetime.utcnow()
+    rows = [{'lot_id': None, 'reason': None, 'created_at': now, **r} for r in rows if r['qty']]
+    for part in chunked(rows, IMPORT_CHUNK_SIZE):
+        db.session.execute(insert(StockMovement), part)
+
+def record_movement(product_id, kind, qty, lot_id=None, reason=None):
+    """Append a movement and apply it to the balances. Returns the new product stock; the caller commits."""
+    if kind not in MOVEMENT_KINDS:
+        raise ValueError(f'tipo movimento sconosciuto: {kind}')
+    db.session.flush()
+    conn = db.session.connection()
+    table = Product.__table__
+    stmt = update(table).where(table.c.id == product_id).values(stock_qty=func.coalesce(table.c.stock_qty, 0) + qty)
+    if conn.dialect.update_returning:
+        stock, min_stock = conn.execute(stmt.returning(table.c.stock_qty, table.c.min_stock)).one()
+    else:
+        conn.execute(stmt)
+        stock, min_stock = conn.execute(select(table.c.stock_qty, table.c.min_stock)
+                                        .where(table.c.id == product_id)).one()
+    _bump_counter(conn, 'low_stock', int(is_low_stock(stock, min_stock)) - int(is_low_stock(stock - qty, min_stock)))
+    if lot_id is not None:
+        lots = Lot.__table__
+        conn.execute(update(lots).where(lots.c.id == lot_id).values(qty=func.coalesce(lots.c.qty, 0) + qty))
+        invalidate_report_cache()
+    conn.execute(insert(StockMovement.__table__).values(product_id=product_id, lot_id=lot_id, kind=kind, qty=qty,
+                                                        reason=reason, created_at=datetime.datetime.utcnow()))
+    bump_session_versions('product', 'stock_movement', *(['lot'] if lot_id is not None else []))
+    log_changes(conn, 'product', [product_id], 'U')
+    if lot_id is not None:
+        log_changes(conn, 'lot', [lot_id], 'U')
+    return stock
+
+class StockConflict(Exception):
+    """A lot went negative because of a concurrent movement; roll back and retry."""
+
+def record_movements(moves):
+    """Batch form of record_movement: a few statements whatever the number of rows.
+
+    Lot and product balances are updated with one CASE-based UPDATE per chunk.
+    Raises StockConflict if a lot would go below zero. Returns {product_id: new stock};
+    the caller commits (or rolls back on StockConflict).
+    """
+    if not moves:
+        return {}
+    db.session.flush()
+    conn = db.session.connection()
+    lots, products = Lot.__table__, Product.__table__
+    by_lot, by_product = {}, {}
+    for m in moves:
+        by_product[m['product_id']] = by_product.get(m['product_id'], 0) + m['qty']
+        if m.get('lot_id') is not None:
+            by_lot[m['lot_id']] = by_lot.get(m['lot_id'], 0) + m['qty']
+    for part in chunked(list(by_lot.items()), IMPORT_CHUNK_SIZE):
+        ids = [lid for lid, _ in part]
+        conn.execute(update(lots).where(lots.c.id.in_(ids))
+                     .values(qty=func.coalesce(lots.c.qty, 0) + case(dict(part), value=lots.c.id)))
+        if conn.execute(select(func.count()).where(lots.c.id.in_(ids), lots.c.qty < 0)).scalar():
+            raise StockConflict('giacenza del lotto insufficiente')
+    stocks, low_delta = {}, 0
+    for part in chunked(list(by_product.items()), IMPORT_CHUNK_SIZE):
+        ids = [pid for pid, _ in part]
+        conn.execute(update(products).where(products.c.id.in_(ids))
+                     .values(stock_qty=func.coalesce(products.c.stock_qty, 0) + case(dict(part), value=products.c.id)))
+        for pid, stock, min_stock in conn.execute(select(products.c.id, products.c.stock_qty, products.c.min_stock)
+                                                  .where(products.c.id.in_(ids))):
+            stocks[pid] = stock
+            low_delta += int(is_low_stock(stock, min_stock)) - int(is_low_stock(stock - by_product[pid], min_stock))
+    _bump_counter(conn, 'low_stock', low_delta)
+    bump_session_versions('product', 'lot')
+    log_changes(conn, 'product', by_product, 'U')
+    log_changes(conn, 'lot', by_lot, 'U')
+    if by_lot:
+        invalidate_report_cache()
+    log_movements(moves)
+    return stocks
+
+def reconcile_stock(dry_run=False):
+    """Rebuild product and lot balances from the ledger; returns how many had drifted."""
+    product_total = func.coalesce(select(func.sum(StockMovement.qty))
+                                  .where(StockMovement.product_id == Product.id).scalar_subquery(), 0)
+    lot_total = (select(func.sum(StockMovement.qty))
+                 .where(StockMovement.lot_id == Lot.id).scalar_subquery())
+    lot_logged = exists().where(StockMovement.lot_id == Lot.id)
+    drift = {
+        'products': db.session.execute(select(func.count(Product.id))
+                                       .where(func.coalesce(Product.stock_qty, 0) != product_total)).scalar(),
+        'lots': db.session.execute(select(func.count(Lot.id))
+                                   .where(lot_logged, func.coalesce(Lot.qty, 0) != lot_total)).scalar(),
+    }
+    if not dry_run:
+        conn = db.session.connection()
+        log_changes_select(conn, 'product', select(Product.id)
+                           .where(func.coalesce(Product.stock_qty, 0) != product_total), 'U')
+        log_changes_select(conn, 'lot', select(Lot.id).where(lot_logged, func.coalesce(Lot.qty, 0) != lot_total), 'U')
+        db.session.execute(update(Product).where(func.coalesce(Product.stock_qty, 0) != product_total)
+                           .values(stock_qty=product_total).execution_options(synchronize_session=False))
+        db.session.execute(update(Lot).where(lot_logged, func.coalesce(Lot.qty, 0) != lot_total)
+                           .values(qty=lot_total).execution_options(synchronize_session=False))
+        db.session.commit()
+        invalidate_report_cache()
+        recompute_dashboard_stats()
+    return drift
+
+# --- Lot archive ---
+# Lots expired for more than LOT_ARCHIVE_GRACE_DAYS, and emptied lots whose
+# last movement is older than that, are moved to lot_archive by `flask archive-lots`
+# in batches: INSERT ... SELECT into the archive, an 'expire' ledger movement
+# for whatever an expired lot still holds (so product stock stays equal to
+# the ledger), then one DELETE. Reports read the archive only on request.
+LOT_ARCHIVE_GRACE_DAYS = int(os.getenv('LOT_ARCHIVE_GRACE_DAYS', '30'))
+LOT_ARCHIVE_BATCH = int(os.getenv('LOT_ARCHIVE_BATCH', '1000'))
+
+def archivable_lots(grace_days):
+    """(condition for lots to archive, condition for the expired ones among them)"""
+    expired = and_(Lot.expiry_date != None,
+                   Lot.expiry_date < datetime.date.today() - datetime.timedelta(days=grace_days))
+    # lots have no creation date: an empty lot qualifies by its last movement, never without one
+    last_moved = (select(func.max(StockMovement.created_at)).where(StockMovement.lot_id == Lot.id)
+                  .scalar_subquery())
+    idle = last_moved < datetime.datetime.utcnow() - datetime.timedelta(days=grace_days)
+    return or_(expired, and_(func.coalesce(Lot.qty, 0) <= 0, idle)), expired
+
+def archive_lots(grace_days=None, batch_size=None, dry_run=False):
+    """Move expired and emptied lots to lot_archive; returns (lots archived, quantity written off)."""
+    grace_days = LOT_ARCHIVE_GRACE_DAYS if grace_days is None else grace_days
+    batch_size = batch_size or LOT_ARCHIVE_BATCH
+    condition, expired = archivable_lots(grace_days)
+    if dry_run:
+        lots, qty = db.session.execute(select(func.count(Lot.id), func.sum(case((and_(expired, Lot.qty > 0), Lot.qty),
+                                                                                else_=0))).where(condition)).one()
+        return lots, qty or 0
+    lots_done = qty_done = 0
+    archive_cols = ['id', 'product_id', 'lot_code', 'expiry_date', 'qty', 'notes', 'reason', 'archived_at']
+    while True:
+        rows = db.session.execute(select(Lot.id, Lot.product_id, Lot.qty, Lot.expiry_date).where(condition)
+                                  .order_by(Lot.id).limit(batch_size).with_for_update()).all()
+        if not rows:
+            break
+        ids = [r.id for r in rows]
+        conn = db.session.connection()
+        conn.execute(insert(LotArchive.__table__).from_select(archive_cols, select(
+            Lot.id, Lot.product_id, Lot.lot_code, Lot.expiry_date, func.coalesce(Lot.qty, 0), Lot.notes,
+            case((expired, 'expired'), else_='empty'), literal(datetime.datetime.utcnow(), db.DateTime))
+            .where(Lot.id.in_(ids))))
+        moves = [{'product_id': r.product_id, 'lot_id': r.id, 'kind': 'expire', 'qty': -r.qty,
+                  'reason': 'Lotto scaduto archiviato'} for r in rows if r.qty and r.qty > 0]
+        record_movements(moves)
+        conn.execute(delete(Lot.__table__).where(Lot.__table__.c.id.in_(ids)))
+        for day, n in Counter(r.expiry_date for r in rows).items():
+            _bump_expiry(conn, day, -n)
+        log_changes(conn, 'lot', ids, 'D')
+        bump_session_versions('lot')
+        db.session.commit()
+        invalidate_report_cache()
+        lots_done += len(rows)
+        qty_done -= sum(m['qty'] for m in moves)
+        if len(rows) < batch_size:
+            break
+    return lots_done, qty_done
+
+# --- Change feed ---
+# change_log records (entity, row id, op) with an increasing sequence for
+# products, lots, price lists and their items: ORM writes are logged by the
+# mapper hooks below, set-based writes call log_changes()/log_changes_select()
+# in the same transaction. /api/changes?since=<seq> returns the rows changed
+# after a sequence, so integrations sync in proportion to what changed.
+CHANGE_FEED_ENTITIES = {
+    'product': (Product, ('sku', 'name', 'category_id', 'supplier_id', 'unit', 'vat', 'cost', 'price',
+                          'stock_qty', 'min_stock')),
+    'lot': (Lot, ('product_id', 'lot_code', 'expiry_date', 'qty')),
+    'price_list': (PriceList, ('name', 'channel', 'currency')),
+    'price_list_item': (PriceListItem, ('price_list_id', 'product_id', 'price')),
+}
+CHANGE_FEED_PAGE = 1000
+CHANGE_FEED_MAX_PAGE = 5000
+# Postgres hands out seq values before commit, so a transaction can commit a
+# lower seq after a reader went past it. Readers therefore page on feed_seq,
+# which sequence_changes() assigns to rows only once they are committed, in
+# one serialized statement: a row committed later always gets a higher one.
+CHANGE_FEED_LOCK = 0x43464551  # pg advisory lock key
+
+def sequence_changes():
+    """Number the committed change_log rows that have no feed_seq yet."""
+    table = ChangeLog.__table__
+    with db.engine.begin() as conn:
+        if conn.execute(select(table.c.seq).where(table.c.feed_seq.is_(None)).limit(1)).first() is None:
+            return
+        if conn.dialect.name == 'postgresql':
+            conn.execute(select(func.pg_advisory_xact_lock(CHANGE_FEED_LOCK)))
+        # contiguous numbers: the pruned-cursor check in change_feed relies on it
+        last = select(func.coalesce(func.max(table.c.feed_seq), 0)).scalar_subquery()
+        pending = (select(table.c.seq, func.row_number().over(order_by=table.c.seq).label('n'))
+                   .where(table.c.feed_seq.is_(None)).subquery())
+        conn.execute(update(table).where(table.c.seq == pending.c.seq).values(feed_seq=last + pending.c.n))
+
+def log_changes(conn, entity, ids, op):
+    now = datetime.datetime.utcnow()
+    for part in chunked(list(ids), IMPORT_CHUNK_SIZE):
+        conn.execute(insert(ChangeLog.__table__),
+                     [{'entity': entity, 'row_id': i, 'op': op, 'changed_at': now} for i in part])
+
+def log_changes_select(conn, entity, ids, op):
+    """Log every id returned by the `ids` select (single column) without fetching them."""
+    sub = ids.subquery()
+    conn.execute(insert(ChangeLog.__table__).from_select(
+        ['entity', 'row_id', 'op', 'changed_at'],
+        select(literal(entity), sub.c[0], literal(op), literal(datetime.datetime.utcnow(), db.DateTime))))
+
+def _log_orm_change(op):
+    def listener(mapper, conn, target):
+        if op == 'U' and not object_session(target).is_modified(target, include_collections=False):
+            return
+        log_changes(conn, mapper.local_table.name, [target.id], op)
+    return listener
+
+for _model, _cols in CHANGE_FEED_ENTITIES.values():
+    for _evt, _op in (('after_insert', 'I'), ('after_update', 'U'), ('after_delete', 'D')):
+        event.listen(_model, _evt, _log_orm_change(_op))
+
+def _feed_value(value):
+    return value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else value
+
+def change_feed(since, limit, entities=None):
+    sequence_changes()
+    oldest = db.session.execute(select(func.min(ChangeLog.feed_seq))).scalar()
+    if oldest and since < oldest - 1:
+        return None  # pruned (since=0 included): the client has to resync from the full exports
+    stmt = (select(ChangeLog.feed_seq, ChangeLog.entity, ChangeLog.row_id, ChangeLog.op)
+            .where(ChangeLog.feed_seq > since).order_by(ChangeLog.feed_seq.asc()).limit(limit))
+    if entities:
+        stmt = stmt.where(ChangeLog.entity.in_(entities))
+    entries = db.session.execute(stmt).all()
+    latest = {}  # several changes of a row in the page collapse into the last one
+    for seq, entity, row_id, op in entries:
+        latest[(entity, row_id)] = (seq, op)
+    rows = {}
+    for entity, (model, cols) in CHANGE_FEED_ENTITIES.items():
+        ids = [row_id for (e, row_id), (seq, op) in latest.items() if e == entity and op != 'D']
+        for part in chunked(ids, IMPORT_CHUNK_SIZE):
+            for r in db.session.execute(select(model.id, *[getattr(model, c) for c in cols]).where(model.id.in_(part))):
+                rows[(entity, r[0])] = {'id': r[0], **{c: _feed_value(v) for c, v in zip(cols, r[1:])}}
+    changes = []
+    for (entity, row_id), (seq, op) in sorted(latest.items(), key=lambda item: item[1][0]):
+        data = rows.get((entity, row_id))
+        if data is None:  # deleted, or deleted after this change was logged
+            changes.append({'seq': seq, 'table': entity, 'id': row_id, 'op': 'delete'})
+        else:
+            changes.append({'seq': seq, 'table': entity, 'id': row_id, 'op': 'upsert', 'data': data})
+    return {'since': since, 'next': entries[-1][0] if entries else since, 'has_more': len(entries) == limit,
+            'changes': changes}
+
+@app.route('/api/changes')
+@login_required
+def api_changes():
+    since = request.args.get('since', 0, type=int)
+    limit = max(1, min(request.args.get('limit', CHANGE_FEED_PAGE, type=int), CHANGE_FEED_MAX_PAGE))
+    entities = [t for t in request.args.get('tables', '').split(',') if t in CHANGE_FEED_ENTITIES]
+    feed = change_feed(since, limit, entities)
+    if feed is None:
+        # sequence to resume from once the full exports, taken after this answer, are loaded
+        latest = db.session.execute(select(func.max(ChangeLog.feed_seq))).scalar()
+        return jsonify(error='sequenza non più disponibile: riallineare con gli export completi', resume=latest), 410
+    return jsonify(feed)
+
+def prune_change_log(keep_days):
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=keep_days)
+    last = db.session.execute(select(func.max(ChangeLog.feed_seq)).where(ChangeLog.changed_at < cutoff)).scalar()
+    if last:
+        # the newest numbered row stays: sequence_changes() continues from it
+        last = min(last, db.session.execute(select(func.max(ChangeLog.feed_seq))).scalar() - 1)
+    removed = db.session.execute(delete(ChangeLog).where(ChangeLog.feed_seq <= last)).rowcount if last else 0
+    db.session.commit()
+    return removed
+
+# --- Data versions / conditional GET ---
+# Each table behind a cached view has a counter in table_version. Tables
+# written by a transaction are collected from flushes of ORM objects, from
+# DML sent through db.session.execute (do_orm_execute) and explicitly with
+# bump_session_versions() for statements run on the raw connection; their
+# counters are bumped in a short transaction of their own once the writing
+# one has committed, so concurrent writers never wait on the counter rows.
+# A counter therefore never runs ahead of the data it stands for. Views
+# call not_modified(tables) first: the ETag is derived from those counters,
+# so a matching If-None-Match gets a 304 before any of the view's queries.
+VERSIONED_TABLES = {'product', 'category', 'supplier', 'price_list', 'price_list_item', 'lot',
+                    'stock_movement', 'import_run', 'valuation_snapshot'}
+
+def bump_versions(conn, names):
+    table = TableVersion.__table__
+    now = datetime.datetime.utcnow()
+    stmt = dialect_insert(table)
+    for name in sorted(VERSIONED_TABLES & set(names)):
+        if stmt is not None:
+            conn.execute(stmt.values(name=name, version=1, updated_at=now).on_conflict_do_update(
+                index_elements=[table.c.name], set_={'version': table.c.version + 1, 'updated_at': now}))
+        elif not conn.execute(update(table).where(table.c.name == name)
+                              .values(version=table.c.version + 1, updated_at=now)).rowcount:
+            conn.execute(insert(table).values(name=name, version=1, updated_at=now))
+
+def _bump_once(session, names):
+    # one bump per table and transaction is enough: readers only see the commit
+    session.info.setdefault('versions_dirty', set()).update(VERSIONED_TABLES & set(names))
+
+def bump_session_versions(*names):
+    _bump_once(db.session(), names)
+
+@event.listens_for(db.session, 'after_flush')
+def _versions_after_flush(session, flush_context):
+    objs = list(session.new) + list(session.deleted) + [o for o in session.dirty if session.is_modified(o)]
+    _bump_once(session, {inspect(o).mapper.local_table.name for o in objs})
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _versions_on_dml(state):
+    if state.is_insert or state.is_update or state.is_delete:
+        table = getattr(state.statement, 'table', None)
+        if getattr(table, 'name', None) in VERSIONED_TABLES:
+            _bump_once(state.session, [table.name])
+
+@event.listens_for(db.session, 'after_commit')
+def _versions_committed(session):
+    dirty = session.info.pop('versions_dirty', None)
+    if dirty:
+        session.info['versions_pending'] = dirty
+
+@event.listens_for(db.session, 'after_rollback')
+def _versions_rolled_back(session):
+    session.info.pop('versions_dirty', None)
+
+@event.listens_for(db.session, 'after_transaction_end')
+def _versions_bump(session, transaction):
+    # runs once the session has given its connection back to the pool
+    pending = session.info.pop('versions_pending', None)
+    if not pending:
+        return
+    try:
+        with db.engine.begin() as conn:
+            bump_versions(conn, pending)
+    except Exception:
+        app.logger.exception('table_version bump failed for %s', ', '.join(sorted(pending)))
+
+def table_versions(tables):
+    return dict(db.session.execute(select(TableVersion.name, TableVersion.version)
+                                   .where(TableVersion.name.in_(tables))).all())
+
+def data_etag(tables, *extra):
+    rows = db.session.execute(select(TableVersion.name, TableVersion.version, TableVersion.updated_at)
+                              .where(TableVersion.name.in_(tables))).all()
+    versions = {name: (version, updated) for name, version, updated in rows}
+    sync_lookups({name: version for name, (version, updated) in versions.items()})
+    user = current_user.get_id() if current_user else None
+    key = '|'.join([request.full_path, str(user), datetime.date.today().isoformat()]
+                   + [f'{t}:{versions.get(t, (0, None))[0]}' for t in sorted(tables)] + [str(e) for e in extra])
+    updated = [u for v, u in versions.values() if u]
+    return hashlib.sha1(key.encode('utf-8')).hexdigest(), max(updated) if updated else None
+
+def not_modified(*tables):
+    """304 response if the client's copy of this page is current, else None."""
+    if request.method not in ('GET', 'HEAD') or flask_session.get('_flashes'):
+        return None
+    etag, last_modified = data_etag(tables)
+    g.data_etag = (etag, last_modified)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    return None
+
+@app.after_request
+def _tag_data_etag(response):
+    validators = g.pop('data_etag', None)
+    if validators and response.status_code == 200:
+        response.set_etag(validators[0], weak=True)
+        if validators[1]:
+            response.last_modified = validators[1]
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# --- Lookup cache ---
+# (id, name) lists of categories and suppliers for forms and filters, kept
+# per process. Writes from this process (ORM hooks and DML through the
+# session) drop the entry when their transaction commits; changes made by
+# other processes (job worker, another gunicorn worker) are noticed through
+# table_version, checked at most every LOOKUP_CHECK_SECONDS, and at once by
+# views with an ETag: data_etag() hands the versions it reads to
+# sync_lookups(), so a page is never built from lists older than its ETag.
+LOOKUP_CHECK_SECONDS = float(os.getenv('LOOKUP_CHECK_SECONDS', '10'))
+LOOKUP_MODELS = {'category': Category, 'supplier': Supplier}
+_lookup_lock = threading.Lock()
+_lookup_cache = {}  # table -> (rows, names, table_version, checked_at)
+
+def _lookup_entry(table):
+    now = time.monotonic()
+    with _lookup_lock:
+        entry = _lookup_cache.get(table)
+    if entry and now - entry[3] < LOOKUP_CHECK_SECONDS:
+        return entry
+    # version first: rows read afterwards are at least as new as the version they are stored with
+    version = db.session.execute(select(TableVersion.version).where(TableVersion.name == table)).scalar() or 0
+    if entry and entry[2] == version:
+        entry = entry[:3] + (now,)
+    else:
+        model = LOOKUP_MODELS[table]
+        rows = [tuple(r) for r in db.session.execute(select(model.id, model.name).order_by(model.name.asc()))]
+        entry = (rows, {name: id_ for id_, name in rows}, version, now)
+    with _lookup_lock:
+        _lookup_cache[table] = entry
+    return entry
+
+def sync_lookups(versions):
+    with _lookup_lock:
+        for table in LOOKUP_MODELS.keys() & versions.keys():
+            entry = _lookup_cache.get(table)
+            if entry and entry[2] != versions[table]:
+                del _lookup_cache[table]
+
+def lookup(table):
+    """[(id, name)] of 'category' or 'supplier', ordered by name."""
+    return _lookup_entry(table)[0]
+
+def lookup_id(table, name):
+    return _lookup_entry(table)[1].get(name)
+
+def lookup_filter(column, table, name):
+    # an unknown name matches nothing (column == None would match the unlinked rows)
+    id_ = lookup_id(table, name)
+    return column == id_ if id_ is not None else false()
+
+def _mark_lookup_dirty(session, tables):
+    if session is not None:
+        session.info.setdefault('lookup_dirty', set()).update(tables)
+
+for _table, _model in LOOKUP_MODELS.items():
+    for _evt in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _evt, lambda mapper, conn, target, _table=_table:
+                     _mark_lookup_dirty(object_session(target), [_table]))
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _lookup_dml(state):
+    table = getattr(state.statement, 'table', None) if state.is_insert or state.is_update or state.is_delete else None
+    if getattr(table, 'name', None) in LOOKUP_MODELS:
+        _mark_lookup_dirty(state.session, [table.name])
+
+@event.listens_for(db.session, 'after_commit')
+def _lookup_commit(session):
+    dirty = session.info.pop('lookup_dirty', None)
+    if dirty:
+        with _lookup_lock:
+            for table in dirty:
+                _lookup_cache.pop(table, None)
+
+@event.listens_for(db.session, 'after_rollback')
+def _lookup_rollback(session):
+    session.info.pop('lookup_dirty', None)
+
+# --- Request instrumentation ---
+# Every request records latency, SQL statement count and time, template
+# render time and response size into in-process histograms served in
+# Prometheus text format at /metrics. The SQL count is also sent as
+# X-Query-Count in debug/testing and shown in the page footer in debug mode.
+# With SLOW_REQUEST_SECONDS set, requests above it are logged with their SQL.
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', '0'))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 500)
+SIZE_BUCKETS = (1000, 10000, 100000, 1000000, 10000000)
+METRICS = {
+    'inventory_request_duration_seconds': ('Request latency by endpoint', LATENCY_BUCKETS),
+    'inventory_request_sql_queries': ('SQL statements per request', QUERY_BUCKETS),
+    'inventory_request_sql_seconds': ('Time spent in SQL per request', LATENCY_BUCKETS),
+    'inventory_template_render_seconds': ('Template render time per request', LATENCY_BUCKETS),
+    'inventory_response_size_bytes': ('Response body size (streamed responses excluded)', SIZE_BUCKETS),
+}
+_metrics_lock = threading.Lock()
+_histograms = {}  # (metric, labels) -> [per-bucket counts..., +Inf count], sum
+
+def observe(metric, labels, value):
+    buckets = METRICS[metric][1]
+    with _metrics_lock:
+        series = _histograms.setdefault((metric, labels), [[0] * (len(buckets) + 1), 0.0])
+        series[0][next((i for i, b in enumerate(buckets) if value <= b), len(buckets))] += 1
+        series[1] += value
+
+def _prom_labels(labels):
+    return '{' + ','.join(f'{k}="{str(v).replace(chr(34), "")}"' for k, v in labels) + '}' if labels else ''
+
+def _prom_histogram(lines, metric, labels, counts, total, buckets):
+    cumulative = 0
+    for bound, n in zip(list(buckets) + ['+Inf'], counts):
+        cumulative += n
+        lines.append(f'{metric}_bucket{_prom_labels(labels + (("le", bound),))} {cumulative}')
+    lines.append(f'{metric}_sum{_prom_labels(labels)} {total:.6f}')
+    lines.append(f'{metric}_count{_prom_labels(labels)} {cumulative}')
+
+def render_metrics():
+    with _metrics_lock:
+        snapshot = {key: (list(counts), total) for key, (counts, total) in _histograms.items()}
+    lines = []
+    for metric, (help_text, buckets) in METRICS.items():
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} histogram']
+        for (name, labels), (counts, total) in sorted(snapshot.items()):
+            if name == metric:
+                _prom_histogram(lines, metric, labels, counts, total, buckets)
+    pool = pool_metrics()
+    lines += ['# HELP inventory_db_pool_checkout_wait_seconds Time waited for a pooled connection',
+              '# TYPE inventory_db_pool_checkout_wait_seconds histogram']
+    _prom_histogram(lines, 'inventory_db_pool_checkout_wait_seconds', (), list(pool['wait_buckets'].values()),
+                    pool['wait_seconds'], POOL_WAIT_BUCKETS)
+    lines += ['# TYPE inventory_db_pool_timeouts_total counter', f"inventory_db_pool_timeouts_total {pool['timeouts']}"]
+    for key in ('size', 'checked_out', 'checked_in', 'overflow'):
+        if key in pool:
+            lines += [f'# TYPE inventory_db_pool_{key} gauge', f'inventory_db_pool_{key} {pool[key]}']
+    return '\n'.join(lines) + '\n'
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+        if context is not None:
+            context.query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _time_query(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'query_started', None)
+    if has_request_context() and started is not None:
+        elapsed = time.perf_counter() - started
+        g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+        sql_log = g.setdefault('sql_log', [])
+        if SLOW_REQUEST_SECONDS and len(sql_log) < 200:
+            sql_log.append((elapsed, statement))
+
+@before_render_template.connect_via(app)
+def _template_started(sender, template, context, **extra):
+    if has_request_context():
+        g.template_started.append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _template_done(sender, template, context, **extra):
+    started = g.get('template_started') if has_request_context() else None
+    if started:
+        g.template_seconds = g.get('template_seconds', 0.0) + time.perf_counter() - started.pop()
+
+@app.before_request
+def _start_request_metrics():
+    g.query_count = 0
+    g.sql_seconds = 0.0
+    g.template_seconds = 0.0
+    g.template_started = []
+    g.sql_log = []
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request_metrics(response):
+    if app.debug or app.testing:
+        response.headers['X-Query-Count'] = str(g.get('query_count', 0))
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    endpoint = request.endpoint or 'unmatched'
+    labels = (('endpoint', endpoint),)
+    observe('inventory_request_duration_seconds',
+            labels + (('method', request.method), ('status', response.status_code)), elapsed)
+    observe('inventory_request_sql_queries', labels, g.get('query_count', 0))
+    observe('inventory_request_sql_seconds', labels, g.get('sql_seconds', 0.0))
+    if g.get('template_seconds'):
+        observe('inventory_template_render_seconds', labels, g.template_seconds)
+    if not response.is_streamed and response.content_length is not None:
+        observe('inventory_response_size_bytes', labels, response.content_length)
+    if SLOW_REQUEST_SECONDS and elapsed >= SLOW_REQUEST_SECONDS:
+        sql = '\n'.join(f'  {t * 1000:8.1f} ms  {" ".join(stmt.split())[:500]}'
+                         for t, stmt in g.get('sql_log', []))
+        app.logger.warning('slow request %s %s: %.3fs, %d queries (%.3fs SQL)\n%s', request.method,
+                           request.full_path.rstrip('?'), elapsed, g.get('query_count', 0),
+                           g.get('sql_seconds', 0.0), sql)
+    return response
+
+@app.route('/metrics')
+@ops_endpoint
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# --- Keyset pagination ---
+# Listings are paged with opaque (sort value, id) cursors instead of OFFSET,
+# so every page costs the same whatever the table size.
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '50'))
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except Exception:
+        return None
+    return values if isinstance(values, list) and len(values) == 2 else None
+
+def page_url(**cursor):
+    args = {k: v for k, v in request.args.items() if k not in ('after', 'before')}
+    args.update(cursor)
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+@app.template_global()
+def sort_url(key):
+    args = {k: v for k, v in request.args.items() if k not in ('after', 'before', 'sort', 'dir')}
+    current = request.args.get('sort')
+    args['sort'] = key
+    if current == key and request.args.get('dir') != 'desc':
+        args['dir'] = 'desc'
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+def sort_params(sorts, default):
+    key = request.args.get('sort', default)
+    if key not in sorts:
+        key = default
+    return key, request.args.get('dir') == 'desc'
+
+def cursor_bound(cursor, parse):
+    # a tampered cursor (wrong types, unparsable value) counts as no cursor
+    if cursor is None:
+        return None
+    value, row_id = cursor
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return None
+    if isinstance(row_id, bool) or not isinstance(row_id, int):
+        return None
+    try:
+        return parse(value), row_id
+    except (TypeError, ValueError):
+        return None
+
+def keyset_page(query, sort, id_col, desc=False):
+    """sort = (column expression, row -> json value[, json value -> bind value])."""
+    expr, value_of = sort[0], sort[1]
+    parse = sort[2] if len(sort) > 2 else (lambda v: v)
+    size = min(max(request.args.get('size', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    after = cursor_bound(decode_cursor(request.args.get('after')), parse)
+    before = cursor_bound(decode_cursor(request.args.get('before')), parse)
+    forward = before is None
+    cursor = after if forward else before
+    ascending = forward != desc
+    if cursor is not None:
+        key, bound = tuple_(expr, id_col), tuple_(*cursor)
+        query = query.filter(key > bound if ascending else key < bound)
+    if ascending:
+        query = query.order_by(expr.asc(), id_col.asc())
+    else:
+        query = query.order_by(expr.desc(), id_col.desc())
+    rows = query.limit(size + 1).all()
+    more = len(rows) > size
+    rows = rows[:size]
+    if not forward:
+        rows.reverse()
+    has_next = more if forward else True
+    has_prev = after is not None if forward else more
+    cursor_of = lambda r: encode_cursor([value_of(r), r.id])
+    return {
+        'items': rows,
+        'size': size,
+        'next_url': page_url(after=cursor_of(rows[-1])) if rows and has_next else None,
+        'prev_url': page_url(before=cursor_of(rows[0])) if rows and has_prev else None,
+    }
+
+PRODUCT_SORTS = {
+    'name': (Product.name, lambda p: p.name),
+    'sku': (Product.sku, lambda p: p.sku),
+    'price': (func.coalesce(Product.price, 0.0), lambda p: p.price or 0.0),
+    'stock': (func.coalesce(Product.stock_qty, 0), lambda p: p.stock_qty or 0),
+}
+SUPPLIER_SORTS = {
+    'name': (Supplier.name, lambda s: s.name),
+}
+NO_EXPIRY = datetime.date(9999, 12, 31)
+LOT_SORTS = {
+    'expiry': (func.coalesce(Lot.expiry_date, NO_EXPIRY), lambda l: (l.expiry_date or NO_EXPIRY).isoformat(),
+               datetime.date.fromisoformat),
+    'lot_code': (Lot.lot_code, lambda l: l.lot_code),
+}
+
 # --- Routes ---
 
 # --- Auth ---
 @app.route('/login', methods=['GET','POST'])
-\1
+def login():
     if request.method == 'POST':
         email = request.form.get('email','').strip().lower()
         password = request.form.get('password','')
@@ -201,34 +1425,32 @@ def logout():
     flash('Disconnesso', 'info')
     return redirect(url_for('login'))
 
-\1@login_required
-\2
-    low_stock = Product.query.filter(Product.stock_qty <= Product.min_stock, Product.min_stock > 0).count()
-    today = datetime.date.today()
-    soon = today + datetime.timedelta(days=30)
-    expiring = Lot.query.filter(Lot.expiry_date != None, Lot.expiry_date <= soon).count()
-    product_count = Product.query.count()
-    price_list_count = PriceList.query.count()
+@app.route('/')
+@login_required
+def index():
+    stats = dashboard_stats(expiring_days=30)
     return render_template('index.html',
-        product_count=product_count,
-        price_list_count=price_list_count,
-        low_stock=low_stock,
-        expiring=expiring
+        product_count=stats.get('products', 0),
+        price_list_count=stats.get('price_lists', 0),
+        low_stock=stats.get('low_stock', 0),
+        expiring=stats['expiring']
     )
 
 # --- Suppliers ---
-\1@login_required
-\2
+@app.route('/suppliers')
+@login_required
+def suppliers():
     q = request.args.get('q','').strip()
     query = Supplier.query
     if q:
-        like = f"%{q}%"
-        query = query.filter(or_(Supplier.name.ilike(like), Supplier.email.ilike(like), Supplier.phone.ilike(like)))
-    rows = query.order_by(Supplier.name.asc()).all()
-    return render_template('suppliers.html', rows=rows, q=q)
+        query = query.filter(search_filter('supplier', q))
+    sort, desc = sort_params(SUPPLIER_SORTS, 'name')
+    page = keyset_page(query, SUPPLIER_SORTS[sort], Supplier.id, desc)
+    return render_template('suppliers.html', rows=page['items'], page=page, q=q)
 
-\1@login_required
-\2
+@app.route('/suppliers/new', methods=['GET','POST'])
+@login_required
+def supplier_new():
     form = SupplierForm()
     if form.validate_on_submit():
         s = Supplier(**form.data)
@@ -238,8 +1460,9 @@ def logout():
         return redirect(url_for('suppliers'))
     return render_template('supplier_form.html', form=form, action='Nuovo')
 
-\1@login_required
-\2
+@app.route('/suppliers/<int:sid>/edit', methods=['GET','POST'])
+@login_required
+def supplier_edit(sid):
     s = Supplier.query.get_or_404(sid)
     form = SupplierForm(obj=s)
     if form.validate_on_submit():
@@ -249,8 +1472,9 @@ def logout():
         return redirect(url_for('suppliers'))
     return render_template('supplier_form.html', form=form, action='Modifica')
 
-\1@login_required
-\2
+@app.route('/suppliers/<int:sid>/delete', methods=['POST'])
+@login_required
+def supplier_delete(sid):
     s = Supplier.query.get_or_404(sid)
     if s.products:
         flash('Impossibile eliminare: ci sono prodotti collegati.', 'warning')
@@ -261,13 +1485,15 @@ def logout():
     return redirect(url_for('suppliers'))
 
 # --- Categories ---
-\1@login_required
-\2
+@app.route('/categories')
+@login_required
+def categories():
     rows = Category.query.order_by(Category.name.asc()).all()
     return render_template('categories.html', rows=rows)
 
-\1@login_required
-\2
+@app.route('/categories/new', methods=['GET','POST'])
+@login_required
+def category_new():
     form = CategoryForm()
     if form.validate_on_submit():
         c = Category(**form.data)
@@ -277,8 +1503,9 @@ def logout():
         return redirect(url_for('categories'))
     return render_template('category_form.html', form=form, action='Nuova')
 
-\1@login_required
-\2
+@app.route('/categories/<int:cid>/edit', methods=['GET','POST'])
+@login_required
+def category_edit(cid):
     c = Category.query.get_or_404(cid)
     form = CategoryForm(obj=c)
     if form.validate_on_submit():
@@ -288,8 +1515,9 @@ def logout():
         return redirect(url_for('categories'))
     return render_template('category_form.html', form=form, action='Modifica')
 
-\1@login_required
-\2
+@app.route('/categories/<int:cid>/delete', methods=['POST'])
+@login_required
+def category_delete(cid):
     c = Category.query.get_or_404(cid)
     if c.products:
         flash('Impossibile eliminare: ci sono prodotti collegati.', 'warning')
@@ -301,26 +1529,32 @@ def logout():
 
 # --- Products ---
 def load_choices(form):
-    form.category_id.choices = [(-1, '— Nessuna —')] + [(c.id, c.name) for c in Category.query.order_by(Category.name.asc()).all()]
-    form.supplier_id.choices = [(-1, '— Nessuno —')] + [(s.id, s.name) for s in Supplier.query.order_by(Supplier.name.asc()).all()]
+    form.category_id.choices = [(-1, '— Nessuna —')] + lookup('category')
+    form.supplier_id.choices = [(-1, '— Nessuno —')] + lookup('supplier')
 
-\1@login_required
-\2
+@app.route('/products')
+@login_required
+def products():
+    cached = not_modified('product', 'category', 'supplier', 'import_run')
+    if cached:
+        return cached
     q = request.args.get('q', '').strip()
     category = request.args.get('category', '').strip()
-    query = Product.query
+    query = product_list_query()
     if q:
-        like = f"%{q}%"
-        query = query.filter(or_(Product.name.ilike(like), Product.sku.ilike(like)))
+        query = query.filter(search_filter('product', q))
     if category:
-        query = query.join(Category, isouter=True).filter(Category.name == category)
-    items = query.order_by(Product.name.asc()).all()
-    categories = db.session.query(Category.name).order_by(Category.name.asc()).all()
-    categories = [c[0] for c in categories]
-    return render_template('products.html', items=items, q=q, category=category, categories=categories)
-
-\1@login_required
-\2
+        query = query.filter(lookup_filter(Product.category_id, 'category', category))
+    sort, desc = sort_params(PRODUCT_SORTS, 'name')
+    page = keyset_page(query, PRODUCT_SORTS[sort], Product.id, desc)
+    categories = [name for _, name in lookup('category')]
+    failed_imports = ImportRun.query.filter_by(status='failed').order_by(ImportRun.id.desc()).limit(5).all()
+    return render_template('products.html', items=page['items'], page=page, q=q, category=category,
+                           categories=categories, failed_imports=failed_imports)
+
+@app.route('/products/new', methods=['GET','POST'])
+@login_required
+def product_new():
     form = ProductForm()
     load_choices(form)
     if form.validate_on_submit():
@@ -329,28 +1563,39 @@ def load_choices(form):
         if data['supplier_id'] == -1: data['supplier_id'] = None
         p = Product(**data)
         db.session.add(p)
+        db.session.flush()
+        log_movements([{'product_id': p.id, 'kind': 'adjust', 'qty': p.stock_qty or 0, 'reason': 'Giacenza iniziale'}])
         db.session.commit()
         flash('Prodotto creato', 'success')
         return redirect(url_for('products'))
     return render_template('product_form.html', form=form, action='Nuovo')
 
-\1@login_required
-\2
+@app.route('/products/<int:pid>/edit', methods=['GET','POST'])
+@login_required
+def product_edit(pid):
     p = Product.query.get_or_404(pid)
     form = ProductForm(obj=p)
     load_choices(form)
     if form.validate_on_submit():
         data = form.data.copy()
+        del form.stock_qty  # stock changes go through the ledger, never as an absolute write
         form.populate_obj(p)
         if data['category_id'] == -1: p.category_id = None
         if data['supplier_id'] == -1: p.supplier_id = None
+        # delta against the stock the form was rendered with, so movements made meanwhile are kept
+        seen = safe_int(request.form.get('stock_seen'), None)
+        delta = (data['stock_qty'] or 0) - seen if seen is not None and data['stock_qty'] is not None else 0
+        if delta:
+            record_movement(p.id, 'adjust', delta, reason='Modifica prodotto')
         db.session.commit()
         flash('Prodotto aggiornato', 'success')
         return redirect(url_for('products'))
-    return render_template('product_form.html', form=form, action='Modifica')
+    return render_template('product_form.html', form=form, action='Modifica',
+                           stock_seen=request.form.get('stock_seen', p.stock_qty or 0))
 
-\1@login_required
-\2
+@app.route('/products/<int:pid>/delete', methods=['POST'])
+@login_required
+def product_delete(pid):
     p = Product.query.get_or_404(pid)
     db.session.delete(p)
     db.session.commit()
@@ -358,112 +1603,532 @@ def load_choices(form):
     return redirect(url_for('products'))
 
 # --- Lots ---
-\1@login_required
-\2
+@app.route('/products/<int:pid>/lots')
+@login_required
+def product_lots(pid):
     p = Product.query.get_or_404(pid)
-    return render_template('product_lots.html', p=p)
-
-\1@login_required
-\2
+    sort, desc = sort_params(LOT_SORTS, 'expiry')
+    page = keyset_page(Lot.query.filter(Lot.product_id == p.id), LOT_SORTS[sort], Lot.id, desc)
+    movements = (StockMovement.query.filter(StockMovement.product_id == p.id)
+                 .order_by(StockMovement.id.desc()).limit(20).all())
+    return render_template('product_lots.html', p=p, lots=page['items'], page=page, today=datetime.date.today(),
+                           movements=movements, kinds=MOVEMENT_KINDS)
+
+@app.route('/products/<int:pid>/lots/new', methods=['POST'])
+@login_required
+def product_lot_new(pid):
     p = Product.query.get_or_404(pid)
     form = LotForm()
     if form.validate_on_submit():
         lot = Lot(product_id=p.id,
                   lot_code=form.lot_code.data,
                   expiry_date=form.expiry_date.data,
-                  qty=form.qty.data or 0,
+                  qty=0,
                   notes=form.notes.data)
         db.session.add(lot)
-        p.stock_qty = (p.stock_qty or 0) + (lot.qty or 0)
+        db.session.flush()
+        if form.qty.data:
+            record_movement(p.id, 'load', form.qty.data, lot_id=lot.id)
         db.session.commit()
         flash('Lotto aggiunto', 'success')
     else:
         flash('Compila correttamente i dati lotto', 'warning')
     return redirect(url_for('product_lots', pid=p.id))
 
-\1@login_required
-\2
+@app.route('/products/<int:pid>/lots/<int:lid>/delete', methods=['POST'])
+@login_required
+def product_lot_delete(pid, lid):
     p = Product.query.get_or_404(pid)
-    lot = Lot.query.get_or_404(lid)
-    qty = lot.qty or 0
+    lot = Lot.query.filter_by(id=lid, product_id=p.id).with_for_update().first_or_404()
+    if lot.qty:
+        record_movement(p.id, 'unload', -lot.qty, lot_id=lot.id, reason=f'Lotto {lot.lot_code} eliminato')
     db.session.delete(lot)
-    p.stock_qty = max(0, (p.stock_qty or 0) - qty)
     db.session.commit()
     flash('Lotto eliminato', 'info')
     return redirect(url_for('product_lots', pid=p.id))
 
+@app.route('/products/<int:pid>/lots/<int:lid>/movement', methods=['POST'])
+@login_required
+def product_lot_movement(pid, lid):
+    p = Product.query.get_or_404(pid)
+    lot = Lot.query.filter_by(id=lid, product_id=p.id).with_for_update().first_or_404()
+    kind = request.form.get('kind', '')
+    qty = safe_int(request.form.get('qty'), 0)
+    if kind not in MOVEMENT_KINDS or not qty:
+        flash('Movimento non valido', 'warning')
+        return redirect(url_for('product_lots', pid=p.id))
+    if kind in ('unload', 'expire'):
+        qty = -abs(qty)
+    elif kind == 'load':
+        qty = abs(qty)
+    if (lot.qty or 0) + qty < 0:
+        flash(f'Quantità non disponibile nel lotto {lot.lot_code} ({lot.qty or 0})', 'warning')
+        return redirect(url_for('product_lots', pid=p.id))
+    record_movement(p.id, kind, qty, lot_id=lot.id, reason=request.form.get('reason') or None)
+    db.session.commit()
+    flash(f'{MOVEMENT_KINDS[kind]} registrato', 'success')
+    return redirect(url_for('product_lots', pid=p.id))
+
+# --- FEFO picking ---
+# First-expired-first-out allocation: the candidate lots of every product in
+# the order are read in one ordered scan of ix_lot_product_expiry (locked FOR
+# UPDATE on Postgres), split in Python and written back with record_movements.
+# Expired lots are never picked; lots without expiry go last.
+FEFO_RETRIES = 3
+
+def fefo_candidates(product_ids, today):
+    found = {}
+    for part in chunked(sorted(product_ids), IMPORT_CHUNK_SIZE):
+        rows = db.session.execute(
+            select(Lot.id, Lot.product_id, Lot.lot_code, Lot.expiry_date, Lot.qty)
+            .where(Lot.product_id.in_(part), Lot.qty > 0, or_(Lot.expiry_date == None, Lot.expiry_date >= today))
+            .order_by(Lot.product_id, Lot.expiry_date.asc().nulls_last(), Lot.id)
+            .with_for_update()).all()
+        for row in rows:
+            found.setdefault(row.product_id, []).append({'lot_id': row.id, 'lot_code': row.lot_code,
+                                                         'expiry_date': row.expiry_date, 'qty': row.qty})
+    return found
+
+def _fefo_int(n, line, field):
+    value = line.get(field)
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).strip().lstrip('-').isdigit():
+        raise ValueError(f'riga {n}: {field} deve essere un numero intero')
+    return int(value)
+
+def _fefo_lines(lines):
+    checked = []
+    for n, line in enumerate(lines, 1):
+        line = dict(line, qty=_fefo_int(n, line, 'qty'))
+        if line['qty'] <= 0:
+            raise ValueError(f'riga {n}: qty deve essere maggiore di zero')
+        if line.get('product_id'):
+            line['product_id'] = _fefo_int(n, line, 'product_id')
+        checked.append(line)
+    return checked
+
+def fefo_allocate(lines, partial=False, dry_run=False, reference=None):
+    """Allocate order lines [{'sku' or 'product_id', 'qty'}] to lots, earliest expiry first.
+
+    Returns {'lines': [...], 'short': [indexes], 'applied': bool}. Nothing is
+    written if a line cannot be fully served, unless partial=True. Raises ValueError
+    naming the first line without a positive integer qty. The caller commits.
+    """
+    lines = _fefo_lines(lines)
+    skus = {str(l['sku']) for l in lines if l.get('sku')}
+    ids = {int(l['product_id']) for l in lines if l.get('product_id')}
+    by_sku, by_id = {}, {}
+    for field, keys in ((Product.sku, sorted(skus)), (Product.id, sorted(ids))):
+        for part in chunked(keys, IMPORT_CHUNK_SIZE):
+            for pid, sku in db.session.execute(select(Product.id, Product.sku).where(field.in_(part))):
+                by_sku[sku], by_id[pid] = pid, sku
+    today = datetime.date.today()
+    available = fefo_candidates(by_id.keys(), today)
+
+    result, short, moves = [], [], []
+    reason = f'Prelievo FEFO {reference}' if reference else 'Prelievo FEFO'
+    for i, line in enumerate(lines):
+        pid = by_sku.get(str(line['sku'])) if line.get('sku') else int(line['product_id'])
+        wanted = line['qty']
+        out = {'sku': by_id.get(pid, line.get('sku')), 'product_id': pid if pid in by_id else None,
+               'qty': wanted, 'allocated': 0, 'lots': []}
+        for lot in available.get(pid, []) if pid in by_id else []:
+            if out['allocated'] >= wanted:
+                break
+            take = min(lot['qty'], wanted - out['allocated'])
+            if take <= 0:
+                continue
+            lot['qty'] -= take
+            out['allocated'] += take
+            out['lots'].append({'lot_id': lot['lot_id'], 'lot_code': lot['lot_code'],
+                                'expiry_date': lot['expiry_date'].isoformat() if lot['expiry_date'] else None,
+                                'qty': take})
+            moves.append({'product_id': pid, 'lot_id': lot['lot_id'], 'kind': 'unload', 'qty': -take, 'reason': reason})
+        if out['allocated'] < wanted:
+            short.append(i)
+        result.append(out)
+
+    applied = bool(moves) and not dry_run and (partial or not short)
+    if applied:
+        record_movements(moves)
+    return {'lines': result, 'short': short, 'applied': applied}
+
+def run_fefo(lines, **kwargs):
+    """fefo_allocate in its own transaction, retried when a concurrent pick empties a lot."""
+    for attempt in range(FEFO_RETRIES):
+        try:
+            allocation = fefo_allocate(lines, **kwargs)
+            if allocation['applied']:
+                db.session.commit()
+            else:
+                db.session.rollback()
+            return allocation
+        except StockConflict:
+            db.session.rollback()
+    raise StockConflict('lotti modificati da un altro prelievo, riprovare')
+
+@app.route('/api/fefo/allocate', methods=['POST'])
+@login_required
+def api_fefo_allocate():
+    payload = request.get_json(silent=True)
+    payload = payload if isinstance(payload, dict) else {}
+    lines = payload.get('lines')
+    if not isinstance(lines, list) or not all(isinstance(l, dict) and (l.get('sku') or l.get('product_id')) for l in lines):
+        return jsonify(error='lines: [{sku|product_id, qty}] attesi'), 400
+    try:
+        allocation = run_fefo(lines, partial=bool(payload.get('partial')), dry_run=bool(payload.get('dry_run')),
+                              reference=payload.get('reference'))
+    except (StockConflict, ValueError, TypeError) as e:
+        return jsonify(error=str(e)), 409 if isinstance(e, StockConflict) else 400
+    status = 409 if allocation['short'] and not payload.get('partial') and not payload.get('dry_run') else 200
+    return jsonify(allocation), status
+
+@app.route('/products/<int:pid>/pick', methods=['POST'])
+@login_required
+def product_pick(pid):
+    p = Product.query.get_or_404(pid)
+    qty = safe_int(request.form.get('qty'), 0)
+    if qty <= 0:
+        flash('Quantità non valida', 'warning')
+        return redirect(url_for('product_lots', pid=p.id))
+    try:
+        allocation = run_fefo([{'product_id': p.id, 'qty': qty}], reference=request.form.get('reference') or None)
+    except StockConflict as e:
+        flash(str(e), 'warning')
+        return redirect(url_for('product_lots', pid=p.id))
+    line = allocation['lines'][0]
+    if not allocation['applied']:
+        flash(f'Disponibili solo {line["allocated"]} su {qty} nei lotti non scaduti: nessun prelievo registrato.', 'warning')
+    else:
+        picked = ', '.join(f'{l["lot_code"]} × {l["qty"]}' for l in line['lots'])
+        flash(f'Prelevati {qty}: {picked}', 'success')
+    return redirect(url_for('product_lots', pid=p.id))
+
+# --- Import engine ---
+# Set-based CSV ingestion: keys of the whole batch are resolved with a few IN
+# queries, then products are written chunk by chunk with one upsert each.
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', '500'))
+
+def parse_product_row(row):
+    sku = row.get('sku')
+    if not sku:
+        return None
+    return {
+        'sku': sku,
+        'name': row.get('name') or '',
+        'category': (row.get('category') or '').strip(),
+        'supplier': (row.get('supplier') or '').strip(),
+        'unit': row.get('unit') or 'pezzi',
+        'vat': safe_int(row.get('vat') or 0),
+        'cost': safe_float(row.get('cost') or 0, 0),
+        'price': safe_float(row.get('price') or 0, 0),
+        'stock_qty': safe_int(row.get('stock_qty') or 0),
+        'min_stock': safe_int(row.get('min_stock') or 0),
+        'notes': row.get('notes') or None,
+    }
+
+def resolve_names(model, names):
+    """Map name -> id for Category/Supplier, creating the missing ones in bulk."""
+    names = sorted(set(n for n in names if n))
+    found = {}
+    for part in chunked(names, IMPORT_CHUNK_SIZE):
+        found.update(db.session.execute(select(model.name, model.id).where(model.name.in_(part))).all())
+    missing = [n for n in names if n not in found]
+    if missing:
+        db.session.execute(insert(model), [{'name': n} for n in missing])
+        for part in chunked(missing, IMPORT_CHUNK_SIZE):
+            found.update(db.session.execute(select(model.name, model.id).where(model.name.in_(part))).all())
+    return found
+
+def _product_upsert(mappings):
+    # Native INSERT .. ON CONFLICT(sku) DO UPDATE; empty category/supplier keep the current link.
+    table = Product.__table__
+    stmt = dialect_insert(table)
+    if stmt is None:
+        return None
+    stmt = stmt.values(mappings)
+    ex = stmt.excluded
+    return stmt.on_conflict_do_update(index_elements=[table.c.sku], set_={
+        'name': ex.name,
+        'category_id': func.coalesce(ex.category_id, table.c.category_id),
+        'supplier_id': func.coalesce(ex.supplier_id, table.c.supplier_id),
+        'unit': ex.unit, 'vat': ex.vat, 'cost': ex.cost, 'price': ex.price,
+        'stock_qty': ex.stock_qty, 'min_stock': ex.min_stock, 'notes': ex.notes,
+    })
+
+def bulk_upsert_products(rows, chunk_size=None):
+    """Import CSV rows (dicts) into Product. The caller commits.
+
+    Returns {'rows', 'rejected', 'seconds', 'chunks': [{'rows', 'inserted', 'updated', 'seconds'}]}.
+    """
+    started = time.perf_counter()
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    records, rejected = [], 0
+    for row in rows:
+        rec = parse_product_row(row)
+        if rec is None:
+            rejected += 1
+        else:
+            records.append(rec)
+    categories = resolve_names(Category, [r['category'] for r in records])
+    suppliers = resolve_names(Supplier, [r['supplier'] for r in records])
+
+    # last occurrence of a SKU wins, as with the old row-by-row import
+    by_sku = {}
+    for r in records:
+        m = {k: v for k, v in r.items() if k not in ('category', 'supplier')}
+        m['category_id'] = categories.get(r['category'])
+        m['supplier_id'] = suppliers.get(r['supplier'])
+        prev = by_sku.get(r['sku'])
+        if prev:
+            m['category_id'] = m['category_id'] or prev['category_id']
+            m['supplier_id'] = m['supplier_id'] or prev['supplier_id']
+        by_sku[r['sku']] = m
+    mappings = list(by_sku.values())
+
+    chunks = []
+    for part in chunked(mappings, chunk_size):
+        t0 = time.perf_counter()
+        skus = [m['sku'] for m in part]
+        # row locks (Postgres) keep concurrent movements out until the import's adjustments are logged
+        stock_before = {sku: (pid, qty or 0) for sku, pid, qty in db.session.execute(
+            select(Product.sku, Product.id, Product.stock_qty).where(Product.sku.in_(skus)).with_for_update()).all()}
+        existing = {sku: pid for sku, (pid, qty) in stock_before.items()}
+        stmt = _product_upsert(part)
+        if stmt is not None:
+            db.session.execute(stmt)
+        else:
+            new_rows, old_rows = [], []
+            for m in part:
+                if m['sku'] not in existing:
+                    new_rows.append(m)
+                    continue
+                m = {k: v for k, v in m.items() if v is not None or k not in ('category_id', 'supplier_id')}
+                m['id'] = existing[m['sku']]
+                old_rows.append(m)
+            if new_rows:
+                db.session.execute(insert(Product), new_rows)
+            if old_rows:
+                db.session.execute(update(Product), old_rows)
+        created = [m['sku'] for m in part if m['sku'] not in existing]
+        if created:
+            stock_before.update((sku, (pid, 0)) for sku, pid in db.session.execute(
+                select(Product.sku, Product.id).where(Product.sku.in_(created))).all())
+        conn = db.session.connection()
+        log_changes(conn, 'product', existing.values(), 'U')
+        log_changes(conn, 'product', [stock_before[sku][0] for sku in created if sku in stock_before], 'I')
+        log_movements([{'product_id': stock_before[m['sku']][0], 'kind': 'adjust', 'reason': 'Import CSV',
+                        'qty': m['stock_qty'] - stock_before[m['sku']][1]}
+                       for m in part if m['sku'] in stock_before])
+        chunks.append({'rows': len(part), 'inserted': len(part) - len(existing),
+                       'updated': len(existing), 'seconds': round(time.perf_counter() - t0, 4)})
+    invalidate_report_cache()
+    return {'rows': len(records), 'rejected': rejected, 'chunks': chunks,
+            'seconds': round(time.perf_counter() - started, 4)}
+
+# Streaming mode: the upload is decoded incrementally and committed every
+# IMPORT_COMMIT_EVERY rows; progress lives in ImportRun so a failed import
+# can be resumed from its last committed chunk.
+IMPORT_COMMIT_EVERY = int(os.getenv('IMPORT_COMMIT_EVERY', '5000'))
+
+def _commit_import_chunk(run, batch, offset):
+    try:
+        result = bulk_upsert_products(batch)
+        run.rows_done = (run.rows_done or 0) + result['rows']
+        run.rows_rejected = (run.rows_rejected or 0) + result['rejected']
+        run.last_offset = offset
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        run.status = 'failed'
+        run.error = f"riga {(run.last_offset or 0) + 1}-{offset}: {e}"[:1000]
+        db.session.commit()
+        raise
+
+def stream_import_products(binary_stream, run, commit_every=None):
+    commit_every = commit_every or IMPORT_COMMIT_EVERY
+    run.status, run.error = 'running', None
+    db.session.commit()
+    reader = csv.DictReader(io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline=''))
+    skip = run.last_offset or 0
+    batch, offset = [], 0
+    for offset, row in enumerate(reader, start=1):
+        if offset <= skip:
+            continue
+        batch.append(row)
+        if len(batch) >= commit_every:
+            _commit_import_chunk(run, batch, offset)
+            batch = []
+    if batch:
+        _commit_import_chunk(run, batch, offset)
+    run.status = 'done'
+    db.session.commit()
+    recompute_dashboard_stats()
+    enqueue_prerender()
+    return run
+
 # --- Import/Export Products ---
-\1@login_required
-\2
-    si = io.StringIO()
-    cw = csv.writer(si)
-    cw.writerow(['sku','name','category','supplier','unit','vat','cost','price','stock_qty','min_stock','notes'])
-    for p in Product.query.order_by(Product.name.asc()).all():
-        cw.writerow([
-            p.sku,p.name,
-            (p.category_ref.name if p.category_ref else ''),
-            (p.supplier_ref.name if p.supplier_ref else ''),
-            p.unit or '',p.vat or 0,p.cost or 0,p.price or 0,p.stock_qty or 0,p.min_stock or 0,(p.notes or '').replace('\n',' ')[:500]
-        ])
-    output = io.BytesIO(si.getvalue().encode('utf-8-sig'))
-    return send_file(output, mimetype='text/csv', as_attachment=True, download_name='products_export.csv')
-
-\1@login_required
-\2
+@app.route('/products/export')
+@login_required
+def products_export():
+    cached = not_modified('product', 'category', 'supplier')
+    if cached:
+        return cached
+    products = product_list_query().order_by(Product.name.asc()).yield_per(EXPORT_BATCH_ROWS)
+    rows = ([
+        p.sku,p.name,
+        (p.category_ref.name if p.category_ref else ''),
+        (p.supplier_ref.name if p.supplier_ref else ''),
+        p.unit or '',p.vat or 0,p.cost or 0,p.price or 0,p.stock_qty or 0,p.min_stock or 0,(p.notes or '').replace('\n',' ')[:500]
+    ] for p in products)
+    header = ['sku','name','category','supplier','unit','vat','cost','price','stock_qty','min_stock','notes']
+    return stream_csv('products_export.csv', header, rows)
+
+@app.route('/products/import', methods=['POST'])
+@login_required
+def products_import():
     file = request.files.get('file')
     if not file:
         flash('Nessun file selezionato', 'warning')
         return redirect(url_for('products'))
-    stream = io.StringIO(file.stream.read().decode('utf-8-sig'))
-    reader = csv.DictReader(stream)
+    if request.form.get('background'):
+        return job_accepted(enqueue_job('products_import', {'filename': file.filename}, payload=file.stream.read()))
+    resume_id = request.form.get('resume', type=int)
+    if resume_id:
+        run = ImportRun.query.get_or_404(resume_id)
+    else:
+        run = ImportRun(filename=file.filename)
+        db.session.add(run)
+    started = time.perf_counter()
+    try:
+        stream_import_products(file.stream, run)
+    except Exception:
+        app.logger.exception('products import %s failed', run.id)
+        flash(f'Import interrotto dopo {run.rows_done} righe: {run.error}. Ricarica il file per riprendere.', 'warning')
+        return redirect(url_for('products'))
+    app.logger.info('products import %s: %d rows in %.2fs', run.id, run.rows_done, time.perf_counter() - started)
+    msg = f'Import completato: {run.rows_done} righe'
+    if run.rows_rejected:
+        msg += f' ({run.rows_rejected} scartate)'
+    flash(msg, 'success')
+    return redirect(url_for('products'))
+
+# --- PDF rendering ---
+# Shared A4 table layout for the price list and expiry PDFs. Rendered files
+# are stored in RenderedDocument keyed by a hash of the rows they show, so a
+# document is only redrawn when its content changes. Expiry reports get one
+# row per filter combination, so only the most recently rendered ones are kept.
+EXPIRING_PDF_KEEP = int(os.getenv('EXPIRING_PDF_KEEP', '20'))
+PdfColumn = namedtuple('PdfColumn', 'title x align max_chars')  # x in cm, negative = from the right edge
+
+def render_table_pdf(title, subtitle_lines, columns, rows):
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A4)
+    width, height = A4
+    xs = [(width + col.x*cm) if col.x < 0 else col.x*cm for col in columns]
+
+    def draw_row(y, values):
+        for col, x, value in zip(columns, xs, values):
+            value = str(value)[:col.max_chars] if col.max_chars else str(value)
+            if col.align == 'right':
+                c.drawRightString(x, y, value)
+            else:
+                c.drawString(x, y, value)
+
+    def draw_header(y):
+        c.setFont("Helvetica-Bold", 11)
+        draw_row(y, [col.title for col in columns])
+        c.setFont("Helvetica", 10)
+        return y - 0.5*cm
+
+    c.setFont("Helvetica-Bold", 16)
+    c.drawString(2*cm, height-2*cm, title)
+    c.setFont("Helvetica", 10)
+    y = height - 2.7*cm
+    for line in subtitle_lines:
+        c.drawString(2*cm, y, line)
+        y -= 0.5*cm
+    y = draw_header(y - 0.3*cm)
+    for values in rows:
+        if y < 3*cm:
+            c.showPage()
+            y = draw_header(height - 2*cm)
+        draw_row(y, values)
+        y -= 0.6*cm
+
+    c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+def as_of_line(day):
+    # a date that is part of the cached content, never the render time
+    return f"Situazione al {day.strftime('%d/%m/%Y')}"
+
+def cached_document(key, content, render, keep=None):
+    """Return the stored document for key if content is unchanged, else render() and store it.
+
+    With keep, only the newest keep documents sharing the key's prefix survive a new render.
+    """
+    digest = hashlib.sha256(json.dumps(content, default=str).encode('utf-8')).hexdigest()
+    doc = db.session.get(RenderedDocument, key)
+    if doc is not None and doc.content_hash == digest:
+        return doc.data
+    data = render()
+    if doc is None:
+        db.session.add(RenderedDocument(key=key, content_hash=digest, data=data))
+    else:
+        doc.content_hash, doc.data, doc.created_at = digest, data, datetime.datetime.utcnow()
+    if keep:
+        db.session.flush()
+        prefix = key.split(':', 1)[0] + ':'
+        newest = (select(RenderedDocument.key).where(RenderedDocument.key.startswith(prefix, autoescape=True))
+                  .order_by(RenderedDocument.created_at.desc(), RenderedDocument.key).limit(keep))
+        db.session.execute(delete(RenderedDocument)
+                           .where(RenderedDocument.key.startswith(prefix, autoescape=True),
+                                  RenderedDocument.key.not_in(newest.scalar_subquery())))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()  # rendered concurrently by another thread/process
+    return data
+
+def pricelist_pdf_rows(pl):
+    return [tuple(r) for r in db.session.execute(
+        select(Product.sku, Product.name, PriceListItem.price)
+        .join_from(PriceListItem, Product, PriceListItem.product_id == Product.id)
+        .where(PriceListItem.price_list_id == pl.id)
+        .order_by(func.lower(Product.name).asc(), PriceListItem.id.asc()))]
+
+def pricelist_pdf(pl):
+    rows = pricelist_pdf_rows(pl)
+    content = [pl.name, pl.channel, pl.currency, rows]
+    return cached_document(f'pricelist:{pl.id}', content, lambda: render_pricelist_pdf(pl, rows))
+
+def expiring_pdf(days, category, supplier, include_archived=False):
+    days, category, supplier, include_archived = report_params(days, category, supplier, include_archived)
+    lots = expiring_report(days, category, supplier, include_archived)
+    today = datetime.date.today()
+    content = [today, days, category, supplier, lots]
+    filters = hashlib.sha1(f'{category}\x00{supplier}'.encode('utf-8')).hexdigest()
+    return cached_document(f"expiring:{days}:{filters}{':archived' if include_archived else ''}", content,
+                           lambda: render_expiring_pdf(days, category, supplier, lots, today),
+                           keep=EXPIRING_PDF_KEEP)
+
+def prerender_pricelists():
     count = 0
-    for row in reader:
-        sku = row.get('sku')
-        if not sku: 
-            continue
-        p = Product.query.filter_by(sku=sku).first()
-        if not p:
-            p = Product(sku=sku, name=row.get('name',''))
-            db.session.add(p)
-        p.name = row.get('name','')
-        # match/create category & supplier by name if provided
-        cat_name = (row.get('category') or '').strip()
-        sup_name = (row.get('supplier') or '').strip()
-        if cat_name:
-            c = Category.query.filter_by(name=cat_name).first()
-            if not c:
-                c = Category(name=cat_name)
-                db.session.add(c)
-                db.session.flush()
-            p.category_id = c.id
-        if sup_name:
-            s = Supplier.query.filter_by(name=sup_name).first()
-            if not s:
-                s = Supplier(name=sup_name)
-                db.session.add(s)
-                db.session.flush()
-            p.supplier_id = s.id
-
-        p.unit = row.get('unit') or 'pezzi'
-        try: p.vat = int(row.get('vat') or 0)
-        except: p.vat = 0
-        try: p.cost = float(row.get('cost') or 0)
-        except: p.cost = 0
-        try: p.price = float(row.get('price') or 0)
-        except: p.price = 0
-        try: p.stock_qty = int(row.get('stock_qty') or 0)
-        except: p.stock_qty = 0
-        try: p.min_stock = int(row.get('min_stock') or 0)
-        except: p.min_stock = 0
-        p.notes = row.get('notes') or None
+    for pl in PriceList.query.order_by(PriceList.id).all():
+        pricelist_pdf(pl)
         count += 1
-    db.session.commit()
-    flash(f'Import completato: {count} righe', 'success')
-    return redirect(url_for('products'))
+    return count
+
+def enqueue_prerender():
+    # one pending pre-render is enough, however many bulk changes happen meanwhile
+    pending = Job.query.filter_by(kind='prerender_pricelists', status='queued').first()
+    return pending or enqueue_job('prerender_pricelists')
 
 # --- Price Lists / PDF + Channel ---
-\1@login_required
-\2
+@app.route('/pricelists')
+@login_required
+def pricelists():
     channel = request.args.get('channel','').strip()
     query = PriceList.query
     if channel:
@@ -472,8 +2137,9 @@ def load_choices(form):
     channels = ['Generale','B2B','B2C','Ho.Re.Ca.']
     return render_template('pricelists.html', lists=lists, channels=channels, channel=channel)
 
-\1@login_required
-\2
+@app.route('/pricelists/new', methods=['GET','POST'])
+@login_required
+def pricelist_new():
     form = PriceListForm()
     if form.validate_on_submit():
         pl = PriceList(**form.data)
@@ -483,8 +2149,9 @@ def load_choices(form):
         return redirect(url_for('pricelists'))
     return render_template('pricelist_form.html', form=form, action='Nuovo')
 
-\1@login_required
-\2
+@app.route('/pricelists/<int:lid>/edit', methods=['GET','POST'])
+@login_required
+def pricelist_edit(lid):
     pl = PriceList.query.get_or_404(lid)
     form = PriceListForm(obj=pl)
     if form.validate_on_submit():
@@ -494,23 +2161,30 @@ def load_choices(form):
         return redirect(url_for('pricelists'))
     return render_template('pricelist_form.html', form=form, action='Modifica')
 
-\1@login_required
-\2
+@app.route('/pricelists/<int:lid>/delete', methods=['POST'])
+@login_required
+def pricelist_delete(lid):
     pl = PriceList.query.get_or_404(lid)
     db.session.delete(pl)
     db.session.commit()
     flash('Listino eliminato', 'info')
     return redirect(url_for('pricelists'))
 
-\1@login_required
-\2
+@app.route('/pricelists/<int:lid>')
+@login_required
+def pricelist_detail(lid):
+    cached = not_modified('price_list', 'price_list_item', 'product')
+    if cached:
+        return cached
     pl = PriceList.query.get_or_404(lid)
     products = Product.query.order_by(Product.name.asc()).all()
     existing = {item.product_id: item for item in pl.items}
-    return render_template('pricelist_detail.html', pl=pl, products=products, existing=existing)
+    other_lists = PriceList.query.filter(PriceList.id != pl.id).order_by(PriceList.name.asc()).all()
+    return render_template('pricelist_detail.html', pl=pl, products=products, existing=existing, other_lists=other_lists)
 
-\1@login_required
-\2
+@app.route('/pricelists/<int:lid>/set', methods=['POST'])
+@login_required
+def pricelist_set_price(lid):
     pl = PriceList.query.get_or_404(lid)
     product_id = int(request.form.get('product_id'))
     price_value = request.form.get('price')
@@ -532,196 +2206,1613 @@ def load_choices(form):
     flash('Prezzo aggiornato', 'success')
     return redirect(url_for('pricelist_detail', lid=lid))
 
-\1@login_required
-\2
-    pl = PriceList.query.get_or_404(lid)
-    si = io.StringIO()
-    cw = csv.writer(si)
-    cw.writerow(['listino', 'canale', 'sku', 'prodotto', 'prezzo', 'valuta'])
-    for item in pl.items:
-        cw.writerow([pl.name, pl.channel, item.product.sku, item.product.name, item.price, pl.currency])
-    output = io.BytesIO(si.getvalue().encode('utf-8-sig'))
-    return send_file(output, mimetype='text/csv', as_attachment=True, download_name=f'{pl.name}_export.csv')
-
-\1@login_required
-\2
-    pl = PriceList.query.get_or_404(lid)
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
-
-    title = f"Listino: {pl.name} • {pl.channel} ({pl.currency})"
-    c.setFont("Helvetica-Bold", 16)
-    c.drawString(2*cm, height-2*cm, title)
-    c.setFont("Helvetica", 10)
-    c.drawString(2*cm, height-2.7*cm, f"Generato: {datetime.datetime.now().strftime('%d/%m/%Y %H:%M')}")
-
-    y = height - 3.5*cm
-    c.setFont("Helvetica-Bold", 11)
-    c.drawString(2*cm, y, "SKU")
-    c.drawString(6*cm, y, "Prodotto")
-    c.drawRightString(width-4*cm, y, "Prezzo")
-    y -= 0.5*cm
-    c.setFont("Helvetica", 10)
+# --- Bulk pricing ---
+# Many prices are written with a handful of set-based statements; copy and
+# derive operations run entirely in SQL as UPDATE .. / INSERT .. SELECT.
+def _price_expr(expr):
+    return func.round(cast(expr, db.Numeric(14, 4)), 2)
+
+def apply_price_changes(lid, changes):
+    """changes: {product_id: price or None (= remove)}. Returns the JSON diff."""
+    ids = list(changes)
+    existing, known = {}, set()
+    for part in chunked(ids, IMPORT_CHUNK_SIZE):
+        for pid, item_id, price in db.session.execute(
+                select(PriceListItem.product_id, PriceListItem.id, PriceListItem.price)
+                .where(PriceListItem.price_list_id == lid, PriceListItem.product_id.in_(part))):
+            existing[pid] = (item_id, price)
+        known.update(db.session.execute(select(Product.id).where(Product.id.in_(part))).scalars())
+    diff = {'added': [], 'updated': [], 'removed': [], 'unchanged': 0, 'unknown': []}
+    inserts, updates, removes = [], [], []
+    for pid, price in changes.items():
+        if pid not in known:
+            diff['unknown'].append(pid)
+            continue
+        item_id, old = existing.get(pid, (None, None))
+        if price is None:
+            if item_id is not None:
+                removes.append(item_id)
+                diff['removed'].append({'product_id': pid, 'old': old})
+        elif item_id is None:
+            inserts.append({'price_list_id': lid, 'product_id': pid, 'price': price})
+            diff['added'].append({'product_id': pid, 'new': price})
+        elif old != price:
+            updates.append({'id': item_id, 'price': price})
+            diff['updated'].append({'product_id': pid, 'old': old, 'new': price})
+        else:
+            diff['unchanged'] += 1
+    conn = db.session.connection()
+    if inserts:
+        db.session.execute(insert(PriceListItem), inserts)
+        for part in chunked([r['product_id'] for r in inserts], IMPORT_CHUNK_SIZE):
+            log_changes_select(conn, 'price_list_item', select(PriceListItem.id).where(
+                PriceListItem.price_list_id == lid, PriceListItem.product_id.in_(part)), 'I')
+    if updates:
+        db.session.execute(update(PriceListItem), updates)
+        log_changes(conn, 'price_list_item', [r['id'] for r in updates], 'U')
+    for part in chunked(removes, IMPORT_CHUNK_SIZE):
+        db.session.execute(delete(PriceListItem).where(PriceListItem.id.in_(part)))
+    log_changes(conn, 'price_list_item', removes, 'D')
+    return diff
+
+def copy_price_list(src_lid, dst_lid, markup=0.0, overwrite=True):
+    src, dst = aliased(PriceListItem), aliased(PriceListItem)
+    factor = 1 + markup / 100.0
+    new_price = _price_expr(src.price * factor)
+    updated = 0
+    if overwrite:
+        same_product = and_(src.price_list_id == src_lid, src.product_id == PriceListItem.product_id)
+        updated = db.session.execute(
+            update(PriceListItem)
+            .where(PriceListItem.price_list_id == dst_lid, exists().where(same_product))
+            .values(price=select(new_price).where(same_product).limit(1).scalar_subquery())
+            .execution_options(synchronize_session=False)).rowcount
+    missing = ~exists().where(dst.price_list_id == dst_lid, dst.product_id == src.product_id)
+    added = db.session.execute(
+        insert(PriceListItem).from_select(['price_list_id', 'product_id', 'price'],
+                                          select(dst_lid, src.product_id, new_price)
+                                          .where(src.price_list_id == src_lid, missing))).rowcount
+    if updated or added:
+        log_changes_select(db.session.connection(), 'price_list_item', select(PriceListItem.id).where(
+            PriceListItem.price_list_id == dst_lid,
+            exists().where(src.price_list_id == src_lid, src.product_id == PriceListItem.product_id)), 'U')
+    return {'updated': updated, 'added': added}
+
+def derive_price_list(lid, margin, overwrite=True):
+    # price such that (price - cost) / price == margin %, as shown in the products list
+    item = aliased(PriceListItem)
+    new_price = _price_expr(Product.cost / (1 - margin / 100.0))
+    updated = 0
+    if overwrite:
+        cost = select(new_price).where(Product.id == PriceListItem.product_id, Product.cost > 0).scalar_subquery()
+        updated = db.session.execute(
+            update(PriceListItem)
+            .where(PriceListItem.price_list_id == lid,
+                   exists().where(Product.id == PriceListItem.product_id, Product.cost > 0))
+            .values(price=cost)
+            .execution_options(synchronize_session=False)).rowcount
+    missing = ~exists().where(item.price_list_id == lid, item.product_id == Product.id)
+    added = db.session.execute(
+        insert(PriceListItem).from_select(['price_list_id', 'product_id', 'price'],
+                                          select(lid, Product.id, new_price)
+                                          .where(Product.cost > 0, missing))).rowcount
+    if updated or added:
+        log_changes_select(db.session.connection(), 'price_list_item', select(PriceListItem.id).where(
+            PriceListItem.price_list_id == lid,
+            exists().where(Product.id == PriceListItem.product_id, Product.cost > 0)), 'U')
+    return {'updated': updated, 'added': added}
+
+def _bulk_price_response(lid, result, message):
+    db.session.commit()
+    enqueue_prerender()
+    if request.is_json:
+        return jsonify(result)
+    flash(message, 'success')
+    return redirect(url_for('pricelist_detail', lid=lid))
 
-    items = sorted(pl.items, key=lambda it: (it.product.name or "").lower())
-    for item in items:
-        line_height = 0.6*cm
-        if y < 3*cm:
-            c.showPage()
-            y = height - 2*cm
-            c.setFont("Helvetica-Bold", 11)
-            c.drawString(2*cm, y, "SKU")
-            c.drawString(6*cm, y, "Prodotto")
-            c.drawRightString(width-4*cm, y, "Prezzo")
-            y -= 0.5*cm
-            c.setFont("Helvetica", 10)
-        c.drawString(2*cm, y, item.product.sku or "")
-        c.drawString(6*cm, y, item.product.name or "")
-        c.drawRightString(width-4*cm, y, f"{item.price:.2f} {pl.currency}")
-        y -= line_height
+@app.route('/pricelists/<int:lid>/prices', methods=['POST'])
+@login_required
+def pricelist_set_prices(lid):
+    pl = PriceList.query.get_or_404(lid)
+    payload = request.get_json(silent=True)
+    items = payload.get('items') if isinstance(payload, dict) else None
+    if not isinstance(items, list):
+        return jsonify(error='items: [{product_id, price}] attesi'), 400
+    changes = {}
+    for n, row in enumerate(items, 1):
+        try:
+            if not isinstance(row, dict):
+                raise ValueError
+            price = row.get('price')
+            product_id = int(row['product_id'])
+            price = None if price in (None, '') else float(price)
+        except (KeyError, TypeError, ValueError):
+            return jsonify(error=f'riga {n}: {{product_id, price}} attesi'), 400
+        if price is not None and (not math.isfinite(price) or price < 0):
+            return jsonify(error=f'riga {n}: prezzo non valido'), 400
+        changes[product_id] = price
+    diff = apply_price_changes(pl.id, changes)
+    db.session.commit()
+    if diff['added'] or diff['updated'] or diff['removed']:
+        enqueue_prerender()
+    return jsonify(diff)
 
-    c.showPage()
-    c.save()
-    buffer.seek(0)
+@app.route('/pricelists/<int:lid>/copy', methods=['POST'])
+@login_required
+def pricelist_copy(lid):
+    pl = PriceList.query.get_or_404(lid)
+    data = request.get_json(silent=True) or request.form
+    source = safe_int(data.get('source'), None)
+    markup = safe_float(data.get('markup'), None)
+    if source is None or markup is None or not math.isfinite(markup) or markup <= -100:
+        if request.is_json:
+            return jsonify(error='listino di origine e ricarico (maggiore di -100) obbligatori'), 400
+        flash('Listino di origine o ricarico non valido (maggiore di -100%)', 'warning')
+        return redirect(url_for('pricelist_detail', lid=pl.id))
+    src = PriceList.query.get_or_404(source)
+    overwrite = str(data.get('overwrite', '1')).lower() in ('1', 'true', 'on')
+    result = copy_price_list(src.id, pl.id, markup, overwrite)
+    return _bulk_price_response(pl.id, result,
+                                f"Copiati prezzi da {src.name}: {result['added']} nuovi, {result['updated']} aggiornati")
+
+@app.route('/pricelists/<int:lid>/derive', methods=['POST'])
+@login_required
+def pricelist_derive(lid):
+    pl = PriceList.query.get_or_404(lid)
+    data = request.get_json(silent=True) or request.form
+    margin = safe_float(data.get('margin'), None)
+    if margin is None or not 0 <= margin < 100:
+        if request.is_json:
+            return jsonify(error='margine tra 0 e 99.99'), 400
+        flash('Margine non valido (0-99,99%)', 'warning')
+        return redirect(url_for('pricelist_detail', lid=pl.id))
+    overwrite = str(data.get('overwrite', '1')).lower() in ('1', 'true', 'on')
+    result = derive_price_list(pl.id, margin, overwrite)
+    return _bulk_price_response(pl.id, result,
+                                f"Prezzi da costo con margine {margin:g}%: {result['added']} nuovi, {result['updated']} aggiornati")
+
+@app.route('/pricelists/<int:lid>/export')
+@login_required
+def pricelist_export(lid):
+    cached = not_modified('price_list', 'price_list_item', 'product')
+    if cached:
+        return cached
+    pl = PriceList.query.get_or_404(lid)
+    name, channel, currency = pl.name, pl.channel, pl.currency
+    items = pricelist_items_query(pl.id).yield_per(EXPORT_BATCH_ROWS)
+    rows = ([name, channel, item.product.sku, item.product.name, item.price, currency] for item in items)
+    return stream_csv(f'{name}_export.csv', ['listino', 'canale', 'sku', 'prodotto', 'prezzo', 'valuta'], rows)
+
+def render_pricelist_pdf(pl, rows):
+    columns = [PdfColumn("SKU", 2, 'left', None), PdfColumn("Prodotto", 6, 'left', None),
+               PdfColumn("Prezzo", -4, 'right', None)]
+    return render_table_pdf(f"Listino: {pl.name} • {pl.channel} ({pl.currency})", [], columns,
+                            ((sku or "", name or "", f"{price:.2f} {pl.currency}") for sku, name, price in rows))
+
+@app.route('/pricelists/<int:lid>/export.pdf')
+@login_required
+def pricelist_export_pdf(lid):
+    cached = not_modified('price_list', 'price_list_item', 'product')
+    if cached:
+        return cached
+    pl = PriceList.query.get_or_404(lid)
+    if request.args.get('background'):
+        return job_accepted(enqueue_job('pricelist_pdf', {'lid': pl.id}))
+    buffer = io.BytesIO(pricelist_pdf(pl))
     return send_file(buffer, as_attachment=True, download_name=f"{pl.name}.pdf", mimetype="application/pdf")
 
-# --- Reports: Expiring Lots ---
-\1@login_required
-\2
-    # params: days (default 30), category(optional), supplier(optional)
+# --- Reports engine ---
+# One flat Lot/Product/Category/Supplier query serves the HTML, CSV and PDF
+# expiry reports. Results are cached for REPORT_CACHE_TTL seconds, keyed by
+# the normalized parameters, today's date and the table_version counters of
+# the tables read, so writes from other processes miss the cache too; writes
+# from this process also drop it at once.
+REPORT_CACHE_TTL = int(os.getenv('REPORT_CACHE_TTL', '300'))
+REPORT_CACHE_MAX_ROWS = int(os.getenv('REPORT_CACHE_MAX_ROWS', '20000'))
+REPORT_CACHE_ENTRIES = 32
+REPORT_MAX_DAYS = 3650
+REPORT_TABLES = ('lot', 'product', 'category', 'supplier')
+ExpiringRow = namedtuple('ExpiringRow', 'expiry_date sku name lot_code qty category supplier archived')
+_report_cache = OrderedDict()
+_report_cache_lock = threading.Lock()
+
+def report_params(days, category='', supplier='', include_archived=False):
     try:
-        days = int(request.args.get('days','30'))
-    except:
+        days = min(max(int(days), 0), REPORT_MAX_DAYS)
+    except (TypeError, ValueError):
         days = 30
-    category = request.args.get('category','').strip()
-    supplier = request.args.get('supplier','').strip()
-
-    today = datetime.date.today()
-    until = today + datetime.timedelta(days=days)
-
-    query = Lot.query.join(Product)
-    query = query.filter(Lot.expiry_date != None, Lot.expiry_date <= until)
+    return days, (category or '').strip(), (supplier or '').strip(), bool(include_archived)
+
+def report_args():
+    """report_params() from the query string of the expiry report views."""
+    args = request.args
+    return report_params(args.get('days', 30, type=int), args.get('category'), args.get('supplier'),
+                         args.get('include_archived'))
+
+def _expiring_lots_select(model, archived, until, category, supplier):
+    stmt = (select(model.expiry_date, Product.sku, Product.name, model.lot_code, model.qty,
+                   Category.name.label('category'), Supplier.name.label('supplier'), literal(archived).label('archived'))
+            .join_from(model, Product, model.product_id == Product.id)
+            .outerjoin(Category, Product.category_id == Category.id)
+            .outerjoin(Supplier, Product.supplier_id == Supplier.id)
+            .where(model.expiry_date != None, model.expiry_date <= until))
     if category:
-        query = query.join(Category, Product.category_id == Category.id).filter(Category.name == category)
+        stmt = stmt.where(lookup_filter(Product.category_id, 'category', category))
     if supplier:
-        query = query.join(Supplier, Product.supplier_id == Supplier.id).filter(Supplier.name == supplier)
+        stmt = stmt.where(lookup_filter(Product.supplier_id, 'supplier', supplier))
+    return stmt
+
+def expiring_report_select(days, category='', supplier='', include_archived=False):
+    until = datetime.date.today() + datetime.timedelta(days=days)
+    stmt = _expiring_lots_select(Lot, False, until, category, supplier)
+    if not include_archived:
+        return stmt.order_by(Lot.expiry_date.asc(), Lot.id.asc())
+    rows = union_all(stmt, _expiring_lots_select(LotArchive, True, until, category, supplier)).subquery()
+    return select(rows).order_by(rows.c.expiry_date.asc(), rows.c.archived.asc(), rows.c.sku.asc(), rows.c.lot_code.asc())
+
+def _report_key(params):
+    # versions first: rows read afterwards are at least as new as the key they are stored under
+    versions = table_versions(REPORT_TABLES)
+    return params + (datetime.date.today(),) + tuple(versions.get(t, 0) for t in REPORT_TABLES)
+
+def _cached_report(key):
+    with _report_cache_lock:
+        hit = _report_cache.get(key)
+        if hit and time.monotonic() - hit[0] < REPORT_CACHE_TTL:
+            return hit[1]
+    return None
+
+def expiring_report(days, category='', supplier='', include_archived=False):
+    """Rows (ExpiringRow) of lots expiring within `days`, served from the cache when fresh."""
+    params = report_params(days, category, supplier, include_archived)
+    key = _report_key(params)
+    rows = _cached_report(key)
+    if rows is not None:
+        return rows
+    rows = [ExpiringRow(*r) for r in db.session.execute(expiring_report_select(*params))]
+    if len(rows) <= REPORT_CACHE_MAX_ROWS:
+        with _report_cache_lock:
+            _report_cache[key] = (time.monotonic(), rows)
+            while len(_report_cache) > REPORT_CACHE_ENTRIES:
+                _report_cache.popitem(last=False)
+    return rows
+
+def iter_expiring_report(days, category='', supplier='', include_archived=False):
+    # cached rows when available, otherwise streamed from the database without caching
+    params = report_params(days, category, supplier, include_archived)
+    rows = _cached_report(_report_key(params))
+    if rows is not None:
+        return iter(rows)
+    stmt = expiring_report_select(*params).execution_options(yield_per=EXPORT_BATCH_ROWS)
+    return (ExpiringRow(*r) for r in db.session.execute(stmt))
+
+def invalidate_report_cache(*args):
+    with _report_cache_lock:
+        _report_cache.clear()
+
+for _model in (Lot, Product, Category, Supplier):
+    for _evt in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _evt, invalidate_report_cache)
+
+# --- Reports: Expiring Lots ---
+@app.route('/reports/expiring')
+@login_required
+def report_expiring():
+    # params: days (default 30), category(optional), supplier(optional)
+    cached = not_modified('lot', 'product', 'category', 'supplier')
+    if cached:
+        return cached
+    days, category, supplier, include_archived = report_args()
 
-    lots = query.order_by(Lot.expiry_date.asc()).all()
+    lots = expiring_report(days, category, supplier, include_archived)
 
-    categories = [c[0] for c in db.session.query(Category.name).order_by(Category.name.asc()).all()]
-    suppliers = [s[0] for s in db.session.query(Supplier.name).order_by(Supplier.name.asc()).all()]
+    categories = [name for _, name in lookup('category')]
+    suppliers = [name for _, name in lookup('supplier')]
 
-    return render_template('report_expiring.html', lots=lots, days=days, category=category, supplier=supplier, categories=categories, suppliers=suppliers)
+    return render_template('report_expiring.html', lots=lots, days=days, category=category, supplier=supplier, categories=categories, suppliers=suppliers, include_archived=include_archived)
 
-\1@login_required
-\2
-    days = int(request.args.get('days','30'))
-    category = request.args.get('category','').strip()
-    supplier = request.args.get('supplier','').strip()
+@app.route('/reports/expiring.csv')
+@login_required
+def report_expiring_csv():
+    cached = not_modified('lot', 'product', 'category', 'supplier')
+    if cached:
+        return cached
+    days, category, supplier, include_archived = report_args()
+
+    rows = ([
+        l.expiry_date.strftime('%Y-%m-%d') if l.expiry_date else '',
+        l.sku, l.name, l.lot_code, l.qty, l.category or '', l.supplier or ''
+    ] + ([int(l.archived)] if include_archived else []) for l in iter_expiring_report(days, category, supplier, include_archived))
+    header = ['scadenza','sku','prodotto','lotto','quantita','categoria','fornitore'] + (['archiviato'] if include_archived else [])
+    return stream_csv(f'expiring_{days}d.csv', header, rows)
+
+def render_expiring_pdf(days, category, supplier, lots, today):
+    filters = []
+    if category: filters.append(f"Categoria: {category}")
+    if supplier: filters.append(f"Fornitore: {supplier}")
+    if any(l.archived for l in lots): filters.append("* lotto archiviato")
+    columns = [PdfColumn("Scadenza", 2, 'left', None), PdfColumn("Prodotto (SKU)", 5, 'left', 40),
+               PdfColumn("Lotto", 11, 'left', 12), PdfColumn("Q.tà", -2, 'right', None)]
+    rows = ((l.expiry_date.strftime('%d/%m/%Y') if l.expiry_date else '—', f"{l.name} ({l.sku})",
+             ('*' if l.archived else '') + (l.lot_code or ''), l.qty or 0) for l in lots)
+    return render_table_pdf(f"Report Scadenze (entro {days} giorni)", [" • ".join(filters), as_of_line(today)],
+                            columns, rows)
+
+@app.route('/reports/expiring.pdf')
+@login_required
+def report_expiring_pdf():
+    cached = not_modified('lot', 'product', 'category', 'supplier')
+    if cached:
+        return cached
+    days, category, supplier, include_archived = report_args()
+
+    if request.args.get('background'):
+        return job_accepted(enqueue_job('expiring_pdf', {'days': days, 'category': category, 'supplier': supplier,
+                                                         'include_archived': include_archived}))
+    buffer = io.BytesIO(expiring_pdf(days, category, supplier, include_archived))
+    return send_file(buffer, as_attachment=True, download_name=f"report_scadenze_{days}d.pdf", mimetype="application/pdf")
 
+# --- Reports: Analytics ---
+# Stock valuation at cost and price, margins and value of expiring stock,
+# grouped by category or supplier with two GROUP BY queries. Daily rows are
+# stored in valuation_snapshot (`flask snapshot-valuation`, e.g. from cron)
+# so a past day or a trend is read back without touching products or lots.
+ANALYTICS_DIMENSIONS = {'category': (Category, Product.category_id), 'supplier': (Supplier, Product.supplier_id)}
+ANALYTICS_FIELDS = ['key', 'products', 'stock_qty', 'stock_cost', 'stock_value', 'stock_value_vat',
+                    'expiring_qty', 'expiring_cost', 'expiring_value']
+ANALYTICS_EXPIRING_DAYS = int(os.getenv('ANALYTICS_EXPIRING_DAYS', '30'))
+
+def analytics_params(args):
+    dimension = args.get('dimension', 'category')
+    if dimension not in ANALYTICS_DIMENSIONS:
+        dimension = 'category'
+    days = safe_int(args.get('days'), ANALYTICS_EXPIRING_DAYS)
+    try:
+        day = datetime.date.fromisoformat(args.get('date', ''))
+    except ValueError:
+        day = None
+    return dimension, days, day
+
+def _with_margins(row):
+    row['margin'] = round(row['stock_value'] - row['stock_cost'], 2)
+    row['margin_pct'] = round(row['margin'] / row['stock_value'] * 100, 1) if row['stock_value'] else None
+    return row
+
+def live_valuation(dimension, days):
+    """Rows (dicts, one per category or supplier) computed from products and lots."""
+    model, fk = ANALYTICS_DIMENSIONS[dimension]
+    qty = func.coalesce(Product.stock_qty, 0)
+    cost, price = func.coalesce(Product.cost, 0), func.coalesce(Product.price, 0)
+    key = func.coalesce(model.name, '')
+    rows = {}
+    for r in db.session.execute(
+            select(key.label('key'), func.count(Product.id), func.sum(qty), func.sum(qty * cost), func.sum(qty * price),
+                   func.sum(qty * price * (1 + func.coalesce(Product.vat, 0) / 100.0)))
+            .select_from(Product).outerjoin(model, fk == model.id).group_by(key)):
+        rows[r[0]] = dict(zip(ANALYTICS_FIELDS, list(r) + [0, 0.0, 0.0]))
     today = datetime.date.today()
-    until = today + datetime.timedelta(days=days)
+    lot_qty = func.coalesce(Lot.qty, 0)
+    for k, n, c, v in db.session.execute(
+            select(key, func.sum(lot_qty), func.sum(lot_qty * cost), func.sum(lot_qty * price))
+            .select_from(Lot).join(Product, Lot.product_id == Product.id).outerjoin(model, fk == model.id)
+            .where(Lot.expiry_date >= today, Lot.expiry_date <= today + datetime.timedelta(days=days))
+            .group_by(key)):
+        row = rows.setdefault(k, dict(zip(ANALYTICS_FIELDS, [k, 0, 0, 0.0, 0.0, 0.0, 0, 0.0, 0.0])))
+        row.update(expiring_qty=n, expiring_cost=c, expiring_value=v)
+    for row in rows.values():
+        for f in ANALYTICS_FIELDS[1:]:
+            row[f] = int(row[f] or 0) if f in ('products', 'stock_qty', 'expiring_qty') else round(float(row[f] or 0), 2)
+    return [_with_margins(row) for row in sorted(rows.values(), key=lambda r: -r['stock_value'])]
+
+def analytics_totals(rows):
+    total = {f: sum(r[f] for r in rows) for f in ANALYTICS_FIELDS[1:]}
+    total = {f: round(v, 2) if isinstance(v, float) else v for f, v in total.items()}
+    return _with_margins(dict(total, key=''))
+
+def snapshot_rows(day, dimension):
+    rows = ValuationSnapshot.query.filter_by(day=day, dimension=dimension).order_by(ValuationSnapshot.stock_value.desc())
+    return [_with_margins({f: getattr(s, f) for f in ANALYTICS_FIELDS}) for s in rows]
+
+def take_valuation_snapshot(day=None, days=None):
+    """Store today's valuation by category, supplier and in total; replaces the day if already taken."""
+    day = day or datetime.date.today()
+    days = days or ANALYTICS_EXPIRING_DAYS
+    records = []
+    for dimension in ANALYTICS_DIMENSIONS:
+        rows = live_valuation(dimension, days)
+        records += [dict({f: r[f] for f in ANALYTICS_FIELDS}, day=day, dimension=dimension, expiring_days=days)
+                    for r in rows]
+    total = analytics_totals(rows)  # either grouping covers every product once
+    records.append(dict({f: total[f] for f in ANALYTICS_FIELDS}, day=day, dimension='total', expiring_days=days))
+    db.session.execute(delete(ValuationSnapshot).where(ValuationSnapshot.day == day))
+    db.session.execute(insert(ValuationSnapshot), records)
+    db.session.commit()
+    return len(records)
+
+def valuation_trend(dimension='total', key='', since=None):
+    since = since or datetime.date.today() - datetime.timedelta(days=365)
+    rows = (ValuationSnapshot.query.filter(ValuationSnapshot.dimension == dimension, ValuationSnapshot.key == key,
+                                           ValuationSnapshot.day >= since)
+            .order_by(ValuationSnapshot.day.asc()))
+    return [_with_margins({'day': s.day.isoformat(), **{f: getattr(s, f) for f in ANALYTICS_FIELDS[1:]}, 'key': s.key})
+            for s in rows]
+
+def analytics_report(args):
+    dimension, days, day = analytics_params(args)
+    if day:
+        rows = snapshot_rows(day, dimension)
+        days = db.session.execute(select(ValuationSnapshot.expiring_days)
+                                  .where(ValuationSnapshot.day == day).limit(1)).scalar() or days
+    else:
+        rows = live_valuation(dimension, days)
+    return {'dimension': dimension, 'days': days, 'date': day.isoformat() if day else None,
+            'rows': rows, 'totals': analytics_totals(rows)}
 
-    query = Lot.query.join(Product)
-    query = query.filter(Lot.expiry_date != None, Lot.expiry_date <= until)
-    if category:
-        query = query.join(Category, Product.category_id == Category.id).filter(Category.name == category)
-    if supplier:
-        query = query.join(Supplier, Product.supplier_id == Supplier.id).filter(Supplier.name == supplier)
-
-    lots = query.order_by(Lot.expiry_date.asc()).all()
-
-    si = io.StringIO()
-    cw = csv.writer(si)
-    cw.writerow(['scadenza','sku','prodotto','lotto','quantita','categoria','fornitore'])
-    for l in lots:
-        cw.writerow([
-            l.expiry_date.strftime('%Y-%m-%d') if l.expiry_date else '',
-            l.product.sku, l.product.name, l.lot_code, l.qty,
-            (l.product.category_ref.name if l.product.category_ref else ''),
-            (l.product.supplier_ref.name if l.product.supplier_ref else '')
-        ])
-    output = io.BytesIO(si.getvalue().encode('utf-8-sig'))
-    return send_file(output, mimetype='text/csv', as_attachment=True, download_name=f'expiring_{days}d.csv')
-
-\1@login_required
-\2
-    days = int(request.args.get('days','30'))
-    category = request.args.get('category','').strip()
-    supplier = request.args.get('supplier','').strip()
+@app.route('/reports/analytics')
+@login_required
+def report_analytics():
+    cached = not_modified('product', 'lot', 'category', 'supplier', 'valuation_snapshot')
+    if cached:
+        return cached
+    report = analytics_report(request.args)
+    snapshot_days = [d for (d,) in db.session.execute(select(ValuationSnapshot.day).distinct()
+                                                       .order_by(ValuationSnapshot.day.desc()).limit(90))]
+    trend = valuation_trend(since=datetime.date.today() - datetime.timedelta(days=90))
+    return render_template('report_analytics.html', report=report, snapshot_days=snapshot_days, trend=trend,
+                           dimensions={'category': 'Categoria', 'supplier': 'Fornitore'})
+
+@app.route('/reports/analytics.csv')
+@login_required
+def report_analytics_csv():
+    cached = not_modified('product', 'lot', 'category', 'supplier', 'valuation_snapshot')
+    if cached:
+        return cached
+    report = analytics_report(request.args)
+    fields = ANALYTICS_FIELDS + ['margin', 'margin_pct']
+    rows = ([r[f] if r[f] is not None else '' for f in fields] for r in report['rows'] + [dict(report['totals'], key='TOTALE')])
+    suffix = report['date'] or datetime.date.today().isoformat()
+    return stream_csv(f"analisi_{report['dimension']}_{suffix}.csv", [report['dimension']] + fields[1:], rows)
+
+@app.route('/reports/analytics.json')
+@login_required
+def report_analytics_json():
+    cached = not_modified('product', 'lot', 'category', 'supplier', 'valuation_snapshot')
+    if cached:
+        return cached
+    return jsonify(analytics_report(request.args))
 
-    today = datetime.date.today()
-    until = today + datetime.timedelta(days=days)
+@app.route('/reports/analytics/trend.json')
+@login_required
+def report_analytics_trend():
+    cached = not_modified('valuation_snapshot')
+    if cached:
+        return cached
+    dimension = request.args.get('dimension', 'total')
+    try:
+        since = datetime.date.fromisoformat(request.args.get('since', ''))
+    except ValueError:
+        since = None
+    return jsonify(valuation_trend(dimension, request.args.get('key', ''), since))
+
+# --- Replenishment ---
+# Reorder quantities for the whole catalog come from one SELECT: stock minus
+# lot quantities expiring before the next delivery (today + lead days) plus
+# what is already on order (proposals sent within the lead time). Products at
+# or under min_stock are ordered up to min_stock * factor. Recomputing
+# replaces the draft proposals with two INSERT ... SELECT (headers grouped by
+# supplier, then lines); no product row goes through Python.
+REORDER_LEAD_DAYS = int(os.getenv('REORDER_LEAD_DAYS', '7'))
+REORDER_FACTOR = float(os.getenv('REORDER_FACTOR', '2'))
+PROPOSAL_STATUSES = {'draft': 'Bozza', 'sent': 'Inviata'}
+
+def reorder_select(lead_days, factor):
+    now = datetime.datetime.utcnow()
+    horizon = datetime.date.today() + datetime.timedelta(days=lead_days)
+    expiring = (select(Lot.product_id, func.sum(Lot.qty).label('qty'))
+                .where(Lot.qty > 0, Lot.expiry_date <= horizon).group_by(Lot.product_id).subquery())
+    on_order = (select(PurchaseProposalLine.product_id, func.sum(PurchaseProposalLine.qty).label('qty'))
+                .join(PurchaseProposal, PurchaseProposalLine.proposal_id == PurchaseProposal.id)
+                .where(PurchaseProposal.status == 'sent',
+                       PurchaseProposal.sent_at >= now - datetime.timedelta(days=lead_days))
+                .group_by(PurchaseProposalLine.product_id).subquery())
+    stock = func.coalesce(Product.stock_qty, 0)
+    expiring_qty = func.coalesce(expiring.c.qty, 0)
+    on_order_qty = func.coalesce(on_order.c.qty, 0)
+    available = stock - expiring_qty + on_order_qty
+    qty = cast(func.round(Product.min_stock * factor), db.Integer) - available
+    unit_cost = func.coalesce(Product.cost, 0)
+    return (select(Product.id.label('product_id'), Product.supplier_id.label('supplier_id'),
+                   stock.label('stock_qty'), Product.min_stock.label('min_stock'),
+                   expiring_qty.label('expiring_qty'), on_order_qty.label('on_order_qty'), qty.label('qty'),
+                   unit_cost.label('unit_cost'), func.round(qty * unit_cost, 2).label('line_cost'))
+            .outerjoin(expiring, expiring.c.product_id == Product.id)
+            .outerjoin(on_order, on_order.c.product_id == Product.id)
+            .where(Product.min_stock > 0, available <= Product.min_stock, qty > 0))
+
+def build_purchase_proposals(lead_days=None, factor=None):
+    """Replace the draft proposals with freshly computed ones; returns (proposals, lines)."""
+    lead_days = REORDER_LEAD_DAYS if lead_days is None else lead_days
+    factor = factor or REORDER_FACTOR
+    drafts = select(PurchaseProposal.id).where(PurchaseProposal.status == 'draft')
+    db.session.execute(delete(PurchaseProposalLine).where(PurchaseProposalLine.proposal_id.in_(drafts))
+                       .execution_options(synchronize_session=False))
+    db.session.execute(delete(PurchaseProposal).where(PurchaseProposal.status == 'draft')
+                       .execution_options(synchronize_session=False))
+    lines = reorder_select(lead_days, factor).subquery()
+    header_cols = ['supplier_id', 'status', 'lead_days', 'created_at', 'lines', 'total_qty', 'total_cost']
+    db.session.execute(insert(PurchaseProposal).from_select(header_cols, select(
+        lines.c.supplier_id, literal('draft'), literal(lead_days), literal(datetime.datetime.utcnow(), db.DateTime),
+        func.count(), func.sum(lines.c.qty), func.round(func.sum(lines.c.line_cost), 2))
+        .group_by(lines.c.supplier_id)))
+    line_cols = ['proposal_id', 'product_id', 'stock_qty', 'min_stock', 'expiring_qty', 'on_order_qty', 'qty',
+                 'unit_cost', 'line_cost']
+    result = db.session.execute(insert(PurchaseProposalLine).from_select(line_cols, select(
+        PurchaseProposal.id, *[lines.c[c] for c in line_cols[1:]])
+        .join(PurchaseProposal, func.coalesce(PurchaseProposal.supplier_id, 0) == func.coalesce(lines.c.supplier_id, 0))
+        .where(PurchaseProposal.status == 'draft')))
+    proposals = db.session.execute(select(func.count(PurchaseProposal.id))
+                                   .where(PurchaseProposal.status == 'draft')).scalar()
+    db.session.commit()
+    return proposals, result.rowcount
 
-    query = Lot.query.join(Product)
-    query = query.filter(Lot.expiry_date != None, Lot.expiry_date <= until)
-    if category:
-        query = query.join(Category, Product.category_id == Category.id).filter(Category.name == category)
-    if supplier:
-        query = query.join(Supplier, Product.supplier_id == Supplier.id).filter(Supplier.name == supplier)
+def proposal_lines(proposal):
+    return db.session.execute(
+        select(PurchaseProposalLine, Product.sku, Product.name, Product.unit)
+        .outerjoin(Product, Product.id == PurchaseProposalLine.product_id)
+        .where(PurchaseProposalLine.proposal_id == proposal.id).order_by(Product.name)).all()
 
-    lots = query.order_by(Lot.expiry_date.asc()).all()
+@app.route('/purchasing')
+@login_required
+def purchasing():
+    proposals = (PurchaseProposal.query.options(joinedload(PurchaseProposal.supplier_ref))
+                 .order_by(PurchaseProposal.status, PurchaseProposal.total_cost.desc()).limit(500).all())
+    drafts = [pp for pp in proposals if pp.status == 'draft']
+    totals = {'lines': sum(pp.lines or 0 for pp in drafts), 'total_cost': sum(pp.total_cost or 0 for pp in drafts)}
+    return render_template('purchasing.html', proposals=proposals, totals=totals, statuses=PROPOSAL_STATUSES,
+                           lead_days=REORDER_LEAD_DAYS, factor=REORDER_FACTOR)
+
+@app.route('/purchasing/recompute', methods=['POST'])
+@login_required
+def purchasing_recompute():
+    lead_days = max(0, safe_int(request.form.get('lead_days'), REORDER_LEAD_DAYS))
+    try:
+        factor = max(1.0, float(request.form.get('factor') or REORDER_FACTOR))
+    except ValueError:
+        factor = REORDER_FACTOR
+    proposals, lines = build_purchase_proposals(lead_days, factor)
+    flash(f'{proposals} proposte di acquisto create ({lines} prodotti da riordinare)', 'success')
+    return redirect(url_for('purchasing'))
+
+@app.route('/purchasing/<int:ppid>')
+@login_required
+def purchase_proposal(ppid):
+    pp = PurchaseProposal.query.get_or_404(ppid)
+    return render_template('purchase_proposal.html', pp=pp, lines=proposal_lines(pp), statuses=PROPOSAL_STATUSES)
 
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
+@app.route('/purchasing/<int:ppid>.csv')
+@login_required
+def purchase_proposal_csv(ppid):
+    pp = PurchaseProposal.query.get_or_404(ppid)
+    rows = ([sku or '', name or '', unit or '', l.qty, l.unit_cost, l.line_cost, l.stock_qty, l.min_stock,
+             l.expiring_qty, l.on_order_qty] for l, sku, name, unit in proposal_lines(pp))
+    return stream_csv(f'proposta_acquisto_{pp.id}.csv',
+                      ['sku', 'name', 'unit', 'qty', 'unit_cost', 'line_cost', 'stock_qty', 'min_stock',
+                       'expiring_qty', 'on_order_qty'], rows)
+
+@app.route('/purchasing/<int:ppid>/send', methods=['POST'])
+@login_required
+def purchase_proposal_send(ppid):
+    pp = PurchaseProposal.query.get_or_404(ppid)
+    if pp.status == 'draft':
+        pp.status = 'sent'
+        pp.sent_at = datetime.datetime.utcnow()
+        db.session.commit()
+        flash('Proposta segnata come inviata: le quantità contano come già ordinate', 'success')
+    return redirect(url_for('purchase_proposal', ppid=pp.id))
 
-    title = f"Report Scadenze (entro {days} giorni)"
-    c.setFont("Helvetica-Bold", 16)
-    c.drawString(2*cm, height-2*cm, title)
-    c.setFont("Helvetica", 10)
-    filters = []
-    if category: filters.append(f"Categoria: {category}")
-    if supplier: filters.append(f"Fornitore: {supplier}")
-    c.drawString(2*cm, height-2.7*cm, " • ".join(filters))
-    c.drawString(2*cm, height-3.2*cm, f"Generato: {datetime.datetime.now().strftime('%d/%m/%Y %H:%M')}")
-
-    y = height - 4.2*cm
-    c.setFont("Helvetica-Bold", 11)
-    c.drawString(2*cm, y, "Scadenza")
-    c.drawString(5*cm, y, "Prodotto (SKU)")
-    c.drawString(11*cm, y, "Lotto")
-    c.drawRightString(width-2*cm, y, "Q.tà")
-    y -= 0.5*cm
-    c.setFont("Helvetica", 10)
+@app.route('/purchasing/<int:ppid>/delete', methods=['POST'])
+@login_required
+def purchase_proposal_delete(ppid):
+    pp = PurchaseProposal.query.get_or_404(ppid)
+    db.session.delete(pp)
+    db.session.commit()
+    flash('Proposta eliminata', 'info')
+    return redirect(url_for('purchasing'))
+
+# --- Price resolution ---
+# Channel prices for the POS are answered from an in-process matrix: one
+# float array per price list indexed by product slot (NaN = no item), plus
+# the product list prices as fallback. It is loaded on first use and kept
+# current from change_log at most every PRICE_MATRIX_REFRESH_SECONDS, so a
+# lookup is a dict access and an array read.
+PRICE_MATRIX_REFRESH_SECONDS = float(os.getenv('PRICE_MATRIX_REFRESH_SECONDS', '1'))
+PRICE_MATRIX_MAX_REPLAY = 20000  # above this many pending changes a full reload is cheaper
+PRICE_BATCH_MAX = 1000
+
+class PriceState:
+    """Everything resolve() reads. A full load builds a new one and swaps it in with one assignment;
+    incremental refreshes grow the arrays before publishing a slot in by_sku, and replace the list
+    metadata as a whole, so lock-free readers never see a half-built matrix."""
+    def __init__(self):
+        self.slots, self.skus, self.by_sku, self.base = {}, [], {}, array('d')
+        self.items = {}  # item id -> (list id, slot), to clear the cell of a deleted item
+        self.meta = ({}, {}, {})  # (lists, by_channel, prices): replaced together
+
+    def set_product(self, pid, sku, price):
+        slot = self.slots.get(pid)
+        if slot is None:
+            slot = len(self.base)
+            for column in self.meta[2].values():
+                column.append(math.nan)
+            self.base.append(math.nan)
+            self.skus.append(None)
+            self.slots[pid] = slot
+        self.base[slot] = math.nan if price is None else price
+        old = self.skus[slot]
+        if old != sku:
+            if old is not None and self.by_sku.get(old) == slot:
+                del self.by_sku[old]
+            self.skus[slot] = sku
+        self.by_sku[sku] = slot
+
+    def drop_product(self, pid):
+        slot = self.slots.pop(pid, None)  # the slot stays, unreachable
+        if slot is not None:
+            sku = self.skus[slot]
+            if sku is not None and self.by_sku.get(sku) == slot:
+                del self.by_sku[sku]
+
+    def set_lists(self, rows):
+        lists = {lid: (name, channel, currency) for lid, name, channel, currency in rows}
+        prices = {lid: self.meta[2].get(lid) or array('d', [math.nan]) * len(self.base) for lid in lists}
+        by_channel = {}
+        for lid, (name, channel, currency) in lists.items():
+            by_channel.setdefault((channel or '').lower(), []).append(lid)
+        self.meta = (lists, by_channel, prices)
+        for item_id in [i for i, (lid, slot) in self.items.items() if lid not in lists]:
+            del self.items[item_id]
+
+    def set_item(self, item_id, lid, pid, price):
+        self.drop_item(item_id)
+        column, slot = self.meta[2].get(lid), self.slots.get(pid)
+        if column is not None and slot is not None:
+            column[slot] = price
+            self.items[item_id] = (lid, slot)
+
+    def drop_item(self, item_id):
+        old = self.items.pop(item_id, None)
+        column = self.meta[2].get(old[0]) if old else None
+        if column is not None:
+            column[old[1]] = math.nan
+
+class PriceMatrix:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = PriceState()
+        self.seq = None
+        self.next_check = 0.0
+
+    @staticmethod
+    def _list_rows():
+        return db.session.execute(select(PriceList.id, PriceList.name, PriceList.channel, PriceList.currency)
+                                  .order_by(PriceList.id))
+
+    def load(self):
+        # sequence first: rows read afterwards are at least that new, replaying later changes is idempotent
+        sequence_changes()
+        seq = db.session.execute(select(func.coalesce(func.max(ChangeLog.feed_seq), 0))).scalar()
+        state = PriceState()
+        for pid, sku, price in db.session.execute(select(Product.id, Product.sku, Product.price)):
+            state.set_product(pid, sku, price)
+        state.set_lists(self._list_rows())
+        for item_id, lid, pid, price in db.session.execute(select(PriceListItem.id, PriceListItem.price_list_id,
+                                                                  PriceListItem.product_id, PriceListItem.price)):
+            state.set_item(item_id, lid, pid, price)
+        self.state, self.seq = state, seq
+
+    def refresh(self):
+        # feed_seq, like /api/changes: a transaction committing after a higher seq was replayed is not skipped
+        sequence_changes()
+        entries = db.session.execute(select(ChangeLog.feed_seq, ChangeLog.entity, ChangeLog.row_id)
+                                     .where(ChangeLog.feed_seq > self.seq).order_by(ChangeLog.feed_seq)
+                                     .limit(PRICE_MATRIX_MAX_REPLAY + 1)).all()
+        oldest = db.session.execute(select(func.min(ChangeLog.feed_seq))).scalar() if entries else None
+        if len(entries) > PRICE_MATRIX_MAX_REPLAY or (oldest and oldest > self.seq + 1):
+            return self.load()
+        state = self.state
+        changed = {}
+        for seq, entity, row_id in entries:
+            changed.setdefault(entity, set()).add(row_id)
+        for part in chunked(sorted(changed.get('product', ())), IMPORT_CHUNK_SIZE):
+            found = set()
+            for pid, sku, price in db.session.execute(select(Product.id, Product.sku, Product.price)
+                                                      .where(Product.id.in_(part))):
+                found.add(pid)
+                state.set_product(pid, sku, price)
+            for pid in set(part) - found:
+                state.drop_product(pid)
+        if changed.get('price_list'):
+            state.set_lists(self._list_rows())
+        for part in chunked(sorted(changed.get('price_list_item', ())), IMPORT_CHUNK_SIZE):
+            found = set()
+            for item_id, lid, pid, price in db.session.execute(
+                    select(PriceListItem.id, PriceListItem.price_list_id, PriceListItem.product_id, PriceListItem.price)
+                    .where(PriceListItem.id.in_(part))):
+                found.add(item_id)
+                state.set_item(item_id, lid, pid, price)
+            for item_id in set(part) - found:
+                state.drop_item(item_id)
+        if entries:
+            self.seq = entries[-1][0]
+
+    def ensure_fresh(self):
+        now = time.monotonic()
+        if self.seq is not None and now < self.next_check:
+            return
+        with self.lock:
+            if self.seq is None:
+                self.load()
+            elif now >= self.next_check:
+                self.refresh()
+            self.next_check = time.monotonic() + PRICE_MATRIX_REFRESH_SECONDS
+
+    def resolve(self, skus, channel=None, list_id=None):
+        """{sku: {'price', 'currency', 'price_list'} or None}; first list of the channel with a price wins."""
+        self.ensure_fresh()
+        state = self.state
+        lists, by_channel, prices = state.meta
+        wanted = [list_id] if list_id is not None else by_channel.get((channel or '').lower(), []) if channel else []
+        columns = [(lid, prices[lid], lists[lid][2]) for lid in wanted if lid in prices]
+        out = {}
+        for sku in skus:
+            slot = state.by_sku.get(sku)
+            if slot is None:
+                out[sku] = None
+                continue
+            for lid, column, currency in columns:
+                price = column[slot]
+                if price == price:  # not NaN
+                    out[sku] = {'price': price, 'currency': currency, 'price_list': lid}
+                    break
+            else:
+                base = state.base[slot]
+                out[sku] = {'price': None if base != base else base, 'currency': 'EUR', 'price_list': None}
+        return out
+
+price_matrix = PriceMatrix()
+
+def _price_params(source):
+    list_id = source.get('list')
+    try:
+        list_id = int(list_id) if list_id not in (None, '') else None
+    except (TypeError, ValueError):
+        abort(400)
+    return (source.get('channel') or '').strip() or None, list_id
 
-    for l in lots:
-        line_h = 0.6*cm
-        if y < 3*cm:
-            c.showPage()
-            y = height - 2*cm
-            c.setFont("Helvetica-Bold", 11)
-            c.drawString(2*cm, y, "Scadenza")
-            c.drawString(5*cm, y, "Prodotto (SKU)")
-            c.drawString(11*cm, y, "Lotto")
-            c.drawRightString(width-2*cm, y, "Q.tà")
-            y -= 0.5*cm
-            c.setFont("Helvetica", 10)
-
-        scad = l.expiry_date.strftime('%d/%m/%Y') if l.expiry_date else '—'
-        c.drawString(2*cm, y, scad)
-        prod = f"{l.product.name} ({l.product.sku})"
-        c.drawString(5*cm, y, prod[:40])
-        c.drawString(11*cm, y, (l.lot_code or '')[:12])
-        c.drawRightString(width-2*cm, y, str(l.qty or 0))
-        y -= line_h
+@app.route('/api/prices/<path:sku>')
+@login_required
+def api_price(sku):
+    channel, list_id = _price_params(request.args)
+    result = price_matrix.resolve([sku], channel, list_id)[sku]
+    if result is None:
+        return jsonify(error='SKU sconosciuto', sku=sku), 404
+    return jsonify(dict(result, sku=sku))
+
+@app.route('/api/prices/resolve', methods=['POST'])
+@login_required
+def api_prices_resolve():
+    payload = request.get_json(silent=True) or {}
+    skus = payload.get('skus')
+    if not isinstance(skus, list) or len(skus) > PRICE_BATCH_MAX:
+        return jsonify(error=f'skus: lista di al massimo {PRICE_BATCH_MAX} codici'), 400
+    channel, list_id = _price_params(payload)
+    return jsonify(prices=price_matrix.resolve([str(s) for s in skus], channel, list_id))
+
+# --- API tokens ---
+# Machine clients send `Authorization: Bearer <token>` on /api/ routes; the
+# request loader logs them in as the token's user for that request only, so
+# the existing @login_required endpoints accept both sessions and tokens.
+API_TOKEN_TOUCH_SECONDS = 60
+
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def create_api_token(user, name):
+    token = secrets.token_urlsafe(32)
+    db.session.add(ApiToken(name=name, user_id=user.id, token_hash=token_digest(token)))
+    db.session.commit()
+    return token
+
+@login_manager.request_loader
+def load_user_from_token(req):
+    auth = req.headers.get('Authorization', '')
+    if not req.path.startswith('/api/') or not auth.startswith('Bearer '):
+        return None
+    token = db.session.execute(select(ApiToken).where(ApiToken.token_hash == token_digest(auth[7:].strip()),
+                                                      ApiToken.revoked_at.is_(None))).scalar()
+    if token is None:
+        return None
+    now = datetime.datetime.utcnow()
+    if not token.last_used_at or (now - token.last_used_at).total_seconds() > API_TOKEN_TOUCH_SECONDS:
+        token.last_used_at = now
+        db.session.commit()
+    return token.user
+
+@login_manager.unauthorized_handler
+def unauthorized():
+    if request.path.startswith('/api/'):
+        response = jsonify(error='autenticazione richiesta')
+        response.status_code = 401
+        response.headers['WWW-Authenticate'] = 'Bearer'
+        return response
+    flash(login_manager.login_message, login_manager.login_message_category)
+    return redirect(login_url(login_manager.login_view, request.url))
+
+# --- Bulk read API ---
+# JSON reads over products, lots, suppliers and categories: only the
+# requested columns are selected, batches of ids or natural keys go through
+# one IN query per chunk, full scans page by id (`after`, `next`).
+API_RESOURCES = {
+    'products': (Product, 'skus', 'sku', ('sku', 'name', 'category_id', 'supplier_id', 'unit', 'vat', 'cost',
+                                          'price', 'stock_qty', 'min_stock', 'notes')),
+    'lots': (Lot, 'product_ids', 'product_id', ('product_id', 'lot_code', 'expiry_date', 'qty', 'notes')),
+    'suppliers': (Supplier, 'names', 'name', ('name', 'vat_number', 'tax_code', 'email', 'phone', 'address',
+                                              'notes')),
+    'categories': (Category, 'names', 'name', ('name', 'description')),
+}
+API_PAGE = 500
+API_MAX_PAGE = 5000
+API_BATCH_MAX = 1000
+
+class ApiError(Exception):
+    pass
+
+def _api_list(value, cast=str):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = [v for v in (v.strip() for v in value.split(',')) if v]
+    if not isinstance(value, list):
+        raise ApiError('atteso un elenco di valori')
+    try:
+        return [cast(v) for v in value]
+    except (TypeError, ValueError):
+        raise ApiError('valore non valido')
+
+def api_read(resource, params):
+    """Rows of a resource as dicts, by batch (ids or natural keys) or a keyset page."""
+    model, key_param, key_field, allowed = API_RESOURCES[resource]
+    fields = _api_list(params.get('fields')) or list(allowed)
+    unknown = [f for f in fields if f not in allowed and f != 'id']
+    if unknown:
+        raise ApiError(f"campi non disponibili: {', '.join(unknown)} (ammessi: id, {', '.join(allowed)})")
+    fields = [f for f in dict.fromkeys(fields) if f != 'id']
+    columns = [model.id] + [getattr(model, f) for f in fields]
+
+    def row(r):  # zip() drops the trailing lookup column of batch queries
+        return {'id': r[0], **{f: _feed_value(v) for f, v in zip(fields, r[1:])}}
+
+    ids = _api_list(params.get('ids'), int)
+    keys = _api_list(params.get(key_param), int if key_field.endswith('_id') else str)
+    if ids or keys:
+        if len(ids) + len(keys) > API_BATCH_MAX:
+            raise ApiError(f'al massimo {API_BATCH_MAX} valori per chiamata')
+        items, found = [], set()
+        for column, values in ((model.id, ids), (getattr(model, key_field), keys)):
+            for part in chunked(list(dict.fromkeys(values)), IMPORT_CHUNK_SIZE):
+                for r in db.session.execute(select(*columns, column).where(column.in_(part)).order_by(model.id)):
+                    found.add(r[-1])
+                    items.append(row(r))
+        missing = [v for v in dict.fromkeys(ids + keys) if v not in found]
+        return {'items': items, 'missing': missing}
+    try:
+        after = int(params.get('after') or 0)
+        limit = max(1, min(int(params.get('limit') or API_PAGE), API_MAX_PAGE))
+    except (TypeError, ValueError):
+        raise ApiError('after e limit devono essere numeri interi')
+    items = [row(r) for r in db.session.execute(select(*columns).where(model.id > after)
+                                                .order_by(model.id).limit(limit))]
+    return {'items': items, 'next': items[-1]['id'] if len(items) == limit else None}
+
+@app.route('/api/<any(products, lots, suppliers, categories):resource>')
+@login_required
+def api_resource(resource):
+    cached = not_modified(API_RESOURCES[resource][0].__tablename__)
+    if cached:
+        return cached
+    try:
+        return jsonify(api_read(resource, request.args))
+    except ApiError as e:
+        return jsonify(error=str(e)), 400
 
-    c.showPage()
-    c.save()
-    buffer.seek(0)
-    return send_file(buffer, as_attachment=True, download_name=f"report_scadenze_{days}d.pdf", mimetype="application/pdf")
+@app.route('/api/<any(products, lots, suppliers, categories):resource>/batch', methods=['POST'])
+@login_required
+def api_resource_batch(resource):
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify(error='corpo JSON mancante'), 400
+    try:
+        return jsonify(api_read(resource, payload))
+    except ApiError as e:
+        return jsonify(error=str(e)), 400
+
+# --- Search API ---
+@app.route('/api/search')
+@login_required
+def api_search():
+    q = request.args.get('q', '').strip()
+    kind = request.args.get('type', 'product')
+    if kind not in SEARCH_FIELDS:
+        abort(400)
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    hits = search(kind, q, limit) if q else []
+    model, cols = SEARCH_FIELDS[kind]
+    rows = {r.id: r for r in model.query.filter(model.id.in_([h[0] for h in hits]))} if hits else {}
+    results = []
+    for rid, score in hits:
+        r = rows.get(rid)
+        if r is not None:
+            results.append(dict({c: getattr(r, c) for c in cols}, id=rid, score=score or 0.0))
+    return jsonify(q=q, type=kind, results=results)
+
+# --- Background jobs ---
+# Heavy imports/exports are stored in the Job table and executed by
+# `flask run-worker`; the browser polls /jobs/<id>/status and downloads the result.
+# A running job holds a lease the worker renews every third of JOB_LEASE_SECONDS;
+# only jobs whose lease ran out (the worker died) go back in the queue.
+JOB_HANDLERS = {}
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '60'))
+JOB_STALE_MINUTES = int(os.getenv('JOB_STALE_MINUTES', '60'))  # jobs started before leases existed
+
+def job_handler(kind):
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+def enqueue_job(kind, params=None, payload=None):
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f'unknown job kind: {kind}')
+    job = Job(kind=kind, params=json.dumps(params or {}), payload=payload)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def job_accepted(job):
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(id=job.id, status=job.status, status_url=url_for('job_status', jid=job.id)), 202
+    return redirect(url_for('job_detail', jid=job.id))
+
+def claim_next_job():
+    while True:
+        jid = db.session.execute(select(Job.id).where(Job.status == 'queued').order_by(Job.id).limit(1)).scalar()
+        if jid is None:
+            db.session.rollback()
+            return None
+        claimed = db.session.execute(update(Job).where(Job.id == jid, Job.status == 'queued')
+                                     .values(status='running', started_at=datetime.datetime.utcnow(),
+                                             lease_until=lease_deadline()))
+        db.session.commit()
+        if claimed.rowcount == 1:
+            return db.session.get(Job, jid)
+
+def lease_deadline():
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=JOB_LEASE_SECONDS)
+
+def _renew_lease(engine, jid, stop):
+    # own connection: the handler's transaction may stay open for a whole chunk
+    while not stop.wait(JOB_LEASE_SECONDS / 3):
+        try:
+            with engine.begin() as conn:
+                conn.execute(update(Job.__table__).where(Job.id == jid, Job.status == 'running')
+                             .values(lease_until=lease_deadline()))
+        except Exception:
+            app.logger.exception('job %s: lease renewal failed', jid)
+
+def run_job(job):
+    jid = job.id
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_renew_lease, args=(db.engine, jid, stop), name=f'job-{jid}-lease', daemon=True)
+    heartbeat.start()
+    try:
+        JOB_HANDLERS[job.kind](job, json.loads(job.params or '{}'))
+        job.status, job.payload = 'done', None
+    except Exception as e:
+        app.logger.exception('job %s (%s) failed', jid, job.kind)
+        db.session.rollback()
+        job = db.session.get(Job, jid)
+        job.status, job.error = 'failed', str(e)[:2000]
+    finally:
+        stop.set()
+        heartbeat.join()
+    # a failed job keeps its upload so /jobs/<id>/retry can resume it
+    job.finished_at, job.lease_until = datetime.datetime.utcnow(), None
+    db.session.commit()
+    return job
+
+def requeue_stale_jobs():
+    now = datetime.datetime.utcnow()
+    legacy = now - datetime.timedelta(minutes=JOB_STALE_MINUTES)
+    expired = or_(Job.lease_until < now, and_(Job.lease_until.is_(None), Job.started_at < legacy))
+    res = db.session.execute(update(Job).where(Job.status == 'running', expired)
+                             .values(status='queued', started_at=None, lease_until=None))
+    db.session.commit()
+    return res.rowcount
+
+@job_handler('products_import')
+def _job_products_import(job, params):
+    # a re-queued import resumes its ImportRun after the last committed chunk
+    run = db.session.get(ImportRun, params['run_id']) if params.get('run_id') else None
+    if run is None:
+        run = ImportRun(filename=params.get('filename'))
+        db.session.add(run)
+        db.session.flush()
+        job.params = json.dumps(dict(params, run_id=run.id))
+    stream_import_products(io.BytesIO(job.payload or b''), run)
+    job.message = f'Import completato: {run.rows_done} righe ({run.rows_rejected} scartate)'
+
+@job_handler('pricelist_pdf')
+def _job_pricelist_pdf(job, params):
+    pl = db.session.get(PriceList, params['lid'])
+    if pl is None:
+        raise ValueError('listino non trovato')
+    job.result = pricelist_pdf(pl)
+    job.result_name, job.result_mimetype = f'{pl.name}.pdf', 'application/pdf'
+
+@job_handler('expiring_pdf')
+def _job_expiring_pdf(job, params):
+    days = int(params.get('days', 30))
+    job.result = expiring_pdf(days, params.get('category', ''), params.get('supplier', ''),
+                              params.get('include_archived', False))
+    job.result_name, job.result_mimetype = f'report_scadenze_{days}d.pdf', 'application/pdf'
+
+@job_handler('prerender_pricelists')
+def _job_prerender_pricelists(job, params):
+    job.message = f'{prerender_pricelists()} listini PDF aggiornati'
+
+@app.route('/jobs/<int:jid>')
+@login_required
+def job_detail(jid):
+    job = Job.query.get_or_404(jid)
+    return render_template('job.html', job=job)
+
+@app.route('/jobs/<int:jid>/status')
+@login_required
+def job_status(jid):
+    job = Job.query.get_or_404(jid)
+    return jsonify(id=job.id, kind=job.kind, status=job.status, message=job.message, error=job.error,
+                   download_url=url_for('job_download', jid=job.id) if job.result is not None else None)
+
+@app.route('/jobs/<int:jid>/retry', methods=['POST'])
+@login_required
+def job_retry(jid):
+    job = Job.query.get_or_404(jid)
+    if job.status != 'failed':
+        abort(409)
+    job.status, job.error, job.started_at, job.finished_at = 'queued', None, None, None
+    db.session.commit()
+    return job_accepted(job)
+
+@app.route('/jobs/<int:jid>/download')
+@login_required
+def job_download(jid):
+    job = Job.query.get_or_404(jid)
+    if job.status != 'done' or job.result is None:
+        abort(404)
+    return send_file(io.BytesIO(job.result), mimetype=job.result_mimetype or 'application/octet-stream',
+                     as_attachment=True, download_name=job.result_name or f'job_{job.id}')
+
+# --- Migrations ---
+# New tables come from create_all(); changes to existing tables (indexes,
+# constraints, search structures) are numbered migrations recorded in
+# schema_version and applied once by `flask db-upgrade` (also run by init-db).
+MIGRATIONS = []
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+def model_indexes(names):
+    found = {idx.name: idx for table in db.metadata.sorted_tables for idx in table.indexes}
+    return [found[name] for name in names]
+
+HOT_INDEXES = ['ix_product_category_id', 'ix_product_supplier_id', 'ix_product_name', 'ix_product_low_stock',
+               'ix_lot_expiry_date', 'ux_price_list_item_list_product']
+
+@migration(1, 'Indice full-text prodotti e fornitori')
+def _migrate_search(conn):
+    init_search(conn)
+
+@migration(2, 'Indici su filtri, join e scadenze; prezzo unico per listino/prodotto')
+def _migrate_hot_indexes(conn):
+    # keep the most recent price where the same product was saved twice in a list
+    conn.execute(text("DELETE FROM price_list_item WHERE id NOT IN "
+                      "(SELECT max(id) FROM price_list_item GROUP BY price_list_id, product_id)"))
+    for idx in model_indexes(HOT_INDEXES):
+        idx.create(conn, checkfirst=True)
+
+@migration(3, 'Movimenti di magazzino: saldi iniziali da lotti e giacenze')
+def _migrate_opening_balances(conn):
+    log_opening_balances(conn)
+
+def log_opening_balances(conn, products=None):
+    """Log a 'load' per lot and an 'adjust' for stock outside lots, so the ledger matches the balances."""
+    products = products if products is not None else select(Product.id)
+    now = literal(datetime.datetime.utcnow(), db.DateTime)
+    opening = literal('Saldo iniziale')
+    moves = StockMovement.__table__
+    cols = [moves.c.product_id, moves.c.lot_id, moves.c.kind, moves.c.qty, moves.c.reason, moves.c.created_at]
+    conn.execute(insert(moves).from_select(cols, select(
+        Lot.product_id, Lot.id, literal('load'), Lot.qty, opening, now)
+        .where(func.coalesce(Lot.qty, 0) != 0, Lot.product_id.in_(products))))
+    lot_sum = func.coalesce(select(func.sum(Lot.qty)).where(Lot.product_id == Product.id).scalar_subquery(), 0)
+    rest = func.coalesce(Product.stock_qty, 0) - lot_sum
+    conn.execute(insert(moves).from_select(cols, select(
+        Product.id, null(), literal('adjust'), rest, opening, now).where(rest != 0, Product.id.in_(products))))
+
+@migration(4, 'Indice lotti per prodotto e scadenza (prelievo FEFO)')
+def _migrate_fefo_index(conn):
+    for idx in model_indexes(['ix_lot_product_expiry']):
+        idx.create(conn, checkfirst=True)
+
+@migration(5, 'Id dei lotti mai riutilizzati (SQLite)')
+def _migrate_lot_autoincrement(conn):
+    # SQLite hands the highest deleted rowid out again unless the table is AUTOINCREMENT;
+    # Postgres sequences never go back
+    if conn.dialect.name != 'sqlite':
+        return
+    ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'lot'")).scalar()
+    if 'AUTOINCREMENT' in ddl.upper():
+        return
+    conn.execute(text('ALTER TABLE lot RENAME TO lot_old'))
+    for idx in Lot.__table__.indexes:
+        conn.execute(text(f'DROP INDEX IF EXISTS {idx.name}'))
+    Lot.__table__.create(conn)
+    cols = ', '.join(c.name for c in Lot.__table__.columns)
+    conn.execute(text(f'INSERT INTO lot ({cols}) SELECT {cols} FROM lot_old'))
+    conn.execute(text('DROP TABLE lot_old'))
+    used = conn.execute(select(func.max(StockMovement.lot_id)).union_all(
+        select(func.max(LotArchive.id)), select(func.max(Lot.id)))).scalars().all()
+    last = max([u for u in used if u is not None], default=0)
+    if not conn.execute(text("UPDATE sqlite_sequence SET seq = max(seq, :last) WHERE name = 'lot'"),
+                        {'last': last}).rowcount:
+        conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('lot', :last)"), {'last': last})
+
+@migration(6, 'Rimozione indici trigrammi inutilizzati (PostgreSQL)')
+def _migrate_drop_trgm(conn):
+    # searches only match the tsvector column, nothing ever used these
+    if conn.dialect.name != 'postgresql':
+        return
+    for table, (model, cols) in SEARCH_FIELDS.items():
+        for c in cols:
+            conn.execute(text(f'DROP INDEX IF EXISTS ix_{table}_{c}_trgm'))
+
+@migration(7, 'Rimozione indice lotti per prodotto (coperto da prodotto e scadenza)')
+def _migrate_drop_lot_product_index(conn):
+    conn.execute(text('DROP INDEX IF EXISTS ix_lot_product_id'))
+
+@migration(8, 'Lease dei job in esecuzione')
+def _migrate_job_lease(conn):
+    if 'lease_until' not in {c['name'] for c in inspect(conn).get_columns('job')}:
+        column = Job.__table__.c.lease_until
+        conn.execute(text(f'ALTER TABLE job ADD COLUMN lease_until {column.type.compile(conn.dialect)}'))
+
+@migration(9, 'Change log numerato in ordine di commit')
+def _migrate_change_log_feed_seq(conn):
+    if 'feed_seq' not in {c['name'] for c in inspect(conn).get_columns('change_log')}:
+        column = ChangeLog.__table__.c.feed_seq
+        conn.execute(text(f'ALTER TABLE change_log ADD COLUMN feed_seq {column.type.compile(conn.dialect)}'))
+    # existing cursors stay valid: logged rows keep their number
+    conn.execute(update(ChangeLog.__table__).where(ChangeLog.feed_seq.is_(None)).values(feed_seq=ChangeLog.seq))
+    for idx in model_indexes(['ux_change_log_feed_seq']):
+        idx.create(conn, checkfirst=True)
+
+@migration(10, 'Ricerca per parte di codice SKU (PostgreSQL)')
+def _migrate_substring_search(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+    for table in SUBSTRING_FIELDS:
+        for stmt in _postgres_substring_ddl(table):
+            conn.execute(text(stmt))
+
+def applied_migrations(conn):
+    return set(conn.execute(select(SchemaVersion.version)).scalars())
+
+def upgrade_database(engine=None, echo=print):
+    engine = engine or db.engine
+    db.metadata.create_all(engine)
+    with engine.connect() as conn:
+        done = applied_migrations(conn)
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        if version in done:
+            continue
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            fn(conn)
+            conn.execute(insert(SchemaVersion).values(version=version, description=description,
+                                                      applied_at=datetime.datetime.utcnow()))
+        echo(f'migrazione {version}: {description} ({time.perf_counter() - started:.2f}s)')
+        applied.append(version)
+    if applied:
+        with engine.begin() as conn:
+            bump_versions(conn, VERSIONED_TABLES)
+    return applied
 
 # Init DB
 @app.cli.command('init-db')
 def init_db():
-    db.create_all()
+    upgrade_database()
     ensure_admin_from_env()
     if not PriceList.query.filter_by(name='Listino Base').first():
         db.session.add(PriceList(name='Listino Base', channel='Generale', currency='EUR', notes='Listino di default'))
         db.session.commit()
     print('Database inizializzato.')
 
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    applied = upgrade_database()
+    print(f'{len(applied)} migrazioni applicate.' if applied else 'Database già aggiornato.')
+
+@app.cli.command('db-status')
+def db_status():
+    with db.engine.connect() as conn:
+        done = applied_migrations(conn) if inspect(conn).has_table('schema_version') else set()
+    for version, description, fn in MIGRATIONS:
+        print(f"{'applicata' if version in done else 'DA APPLICARE'}  {version:>3}  {description}")
+
+# Synthetic data for benchmarks: plain Core inserts (no ORM events), fixed seed.
+def seed_synthetic_data(conn, products=50000, lots_per_product=3, price_lists=3,
+                        categories=50, suppliers=200, seed=42):
+    rnd = random.Random(seed)
+    today = datetime.date.today()
+    conn.execute(insert(Category), [{'name': f'Categoria {i:03d}'} for i in range(categories)])
+    conn.execute(insert(Supplier), [{'name': f'Fornitore {i:04d}'} for i in range(suppliers)])
+    conn.execute(insert(PriceList), [{'name': f'Listino sintetico {i}', 'channel': 'Generale', 'currency': 'EUR'}
+                                     for i in range(price_lists)])
+    cat_ids = list(conn.execute(select(Category.id)).scalars())
+    sup_ids = list(conn.execute(select(Supplier.id)).scalars())
+    list_ids = list(conn.execute(select(PriceList.id)).scalars())
+    words = ['Olio', 'Pasta', 'Farina', 'Vino', 'Caffè', 'Riso', 'Pomodoro', 'Formaggio', 'Salame', 'Miele']
+    rows = []
+    for i in range(products):
+        cost = round(rnd.uniform(0.5, 40), 2)
+        rows.append({'sku': f'SYN{i:07d}', 'name': f'{rnd.choice(words)} {rnd.choice(words).lower()} {i}',
+                     'category_id': rnd.choice(cat_ids), 'supplier_id': rnd.choice(sup_ids),
+                     'unit': 'pezzi', 'vat': 10, 'cost': cost, 'price': round(cost * 1.4, 2),
+                     'stock_qty': rnd.randint(0, 200), 'min_stock': rnd.choice((0, 0, 10, 25))})
+    for batch in chunked(rows, 5000):
+        conn.execute(insert(Product), batch)
+    product_ids = list(conn.execute(select(Product.id)).scalars())
+    for batch in chunked(product_ids, 5000):
+        conn.execute(insert(Lot), [{'product_id': pid, 'lot_code': f'L{pid}-{n}', 'qty': rnd.randint(1, 50),
+                                    'expiry_date': today + datetime.timedelta(days=rnd.randint(-30, 720))}
+                                   for pid in batch for n in range(lots_per_product)])
+        conn.execute(insert(PriceListItem), [{'price_list_id': lid, 'product_id': pid, 'price': rnd.uniform(1, 60)}
+                                             for pid in batch for lid in list_ids])
+    # without opening movements reconcile-stock would zero every seeded balance
+    log_opening_balances(conn, select(Product.id).where(Product.sku.startswith('SYN')))
+    return {'products': len(product_ids), 'lots': len(product_ids) * lots_per_product,
+            'price_list_items': len(product_ids) * len(list_ids)}
+
+def hot_queries(conn):
+    today = datetime.date.today()
+    category_id = conn.execute(select(func.min(Category.id))).scalar()
+    supplier_id = conn.execute(select(func.min(Supplier.id))).scalar()
+    product_id = conn.execute(select(func.max(Product.id))).scalar()
+    list_id = conn.execute(select(func.min(PriceList.id))).scalar()
+    return {
+        'products_by_category': select(Product.id, Product.name).where(Product.category_id == category_id)
+                                .order_by(Product.name).limit(PAGE_SIZE),
+        'products_by_supplier': select(Product.id, Product.name).where(Product.supplier_id == supplier_id)
+                                .order_by(Product.name).limit(PAGE_SIZE),
+        'products_by_name': select(Product.id, Product.name).order_by(Product.name, Product.id).limit(PAGE_SIZE),
+        'lots_expiring_30d': select(func.count(Lot.id)).where(Lot.expiry_date >= today,
+                                                               Lot.expiry_date <= today + datetime.timedelta(days=30)),
+        'lots_of_product': select(Lot.id).where(Lot.product_id == product_id),
+        'price_item_lookup': select(PriceListItem.id).where(PriceListItem.price_list_id == list_id,
+                                                            PriceListItem.product_id == product_id),
+        'low_stock_count': select(func.count(Product.id)).where(Product.min_stock > 0,
+                                                                 Product.stock_qty <= Product.min_stock),
+    }
+
+def explain_and_time(conn, stmt, repeat):
+    sql = str(stmt.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True}))
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+    plan = [' '.join(str(c) for c in row[-1:]) for row in conn.execute(text(prefix + sql))]
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.execute(stmt).all()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {'plan': plan, 'median_ms': round(timings[len(timings) // 2], 3)}
+
+@app.cli.command('bench-indexes')
+@click.option('--products', default=50000, show_default=True)
+@click.option('--repeat', default=15, show_default=True)
+@click.option('--url', default=None, help='Database vuoto da usare (default: SQLite temporaneo).')
+def bench_indexes(products, repeat, url):
+    """Piani e latenze delle query principali prima e dopo la migrazione 2."""
+    tmpdir = None
+    if url is None:
+        tmpdir = tempfile.mkdtemp(prefix='bench-indexes-')
+        url = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+    engine = create_engine(url)
+    try:
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            for idx in model_indexes(HOT_INDEXES):
+                idx.drop(conn, checkfirst=True)
+            seeded = seed_synthetic_data(conn, products=products)
+        report = {'database': engine.dialect.name, 'seeded': seeded, 'queries': {}}
+        for phase in ('before', 'after'):
+            with engine.begin() as conn:
+                if phase == 'after':
+                    started = time.perf_counter()
+                    _migrate_hot_indexes(conn)
+                    report['migration_seconds'] = round(time.perf_counter() - started, 3)
+                conn.execute(text('ANALYZE'))
+            with engine.connect() as conn:
+                for name, stmt in hot_queries(conn).items():
+                    report['queries'].setdefault(name, {})[phase] = explain_and_time(conn, stmt, repeat)
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    finally:
+        engine.dispose()
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+# --- Benchmark suite ---
+# `flask bench` seeds a synthetic inventory into an empty database and runs
+# the scenarios below through the test client, printing latency
+# percentiles, SQL statements and peak Python memory per scenario as JSON.
+# Point DATABASE_URL at a scratch database: the data is not removed.
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))]
+
+def bench_import_csv(rows, existing):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['sku', 'name', 'category', 'supplier', 'unit', 'vat', 'cost', 'price', 'stock_qty', 'min_stock', 'notes'])
+    for i in range(rows):
+        # half the rows update seeded products, half create new ones
+        sku = f'SYN{i % existing:07d}' if i % 2 == 0 and existing else f'IMP{i:07d}'
+        writer.writerow([sku, f'Articolo importato {i}', f'Categoria {i % 50:03d}', f'Fornitore {i % 200:04d}',
+                         'pezzi', 10, '2.50', '3.90', i % 40, 5, ''])
+    return out.getvalue().encode('utf-8')
+
+def bench_scenarios(import_rows, products):
+    list_id = db.session.execute(select(func.min(PriceList.id))).scalar()
+    import_body = bench_import_csv(import_rows, products)
+
+    def clear_pdf_cache():
+        db.session.execute(delete(RenderedDocument))
+        db.session.commit()
+
+    return [
+        # name, method, path, request kwargs factory, setup, single run
+        ('products_list', 'GET', '/products', None, None, False),
+        ('products_search', 'GET', '/products?q=olio', None, None, False),
+        ('products_category', 'GET', '/products?category=Categoria%20007', None, None, False),
+        ('suppliers_search', 'GET', '/suppliers?q=fornitore', None, None, False),
+        ('report_expiring', 'GET', '/reports/expiring?days=30', None, invalidate_report_cache, False),
+        ('report_expiring_csv', 'GET', '/reports/expiring.csv?days=90', None, invalidate_report_cache, False),
+        ('report_expiring_pdf', 'GET', '/reports/expiring.pdf?days=30', None, clear_pdf_cache, False),
+        ('pricelist_export_csv', 'GET', f'/pricelists/{list_id}/export', None, None, False),
+        ('pricelist_export_pdf', 'GET', f'/pricelists/{list_id}/export.pdf', None, clear_pdf_cache, False),
+        ('products_export_csv', 'GET', '/products/export', None, None, False),
+        ('products_import', 'POST', '/products/import',
+         lambda: {'data': {'file': (io.BytesIO(import_body), 'bench.csv')}, 'content_type': 'multipart/form-data'},
+         None, True),
+    ]
+
+def run_bench_scenario(client, method, path, kwargs, setup, repeat):
+    timings, queries, peaks, statuses, sizes = [], [], [], set(), []
+    executed = [0]
+
+    def count(*args):
+        executed[0] += 1
+
+    for _ in range(repeat):
+        if setup:
+            setup()
+        db.session.remove()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        # counted on the engine rather than X-Query-Count so streamed exports are included
+        executed[0] = 0
+        event.listen(Engine, 'before_cursor_execute', count)
+        started = time.perf_counter()
+        try:
+            response = client.open(path, method=method, **(kwargs() if kwargs else {}))
+            size = len(response.get_data())  # drains streamed responses
+            timings.append((time.perf_counter() - started) * 1000)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', count)
+        peaks.append(tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0)
+        queries.append(executed[0])
+        statuses.add(response.status_code)
+        sizes.append(size)
+        response.close()
+    return {'runs': repeat, 'status': sorted(statuses),
+            'p50_ms': round(percentile(timings, 50), 2), 'p95_ms': round(percentile(timings, 95), 2),
+            'p99_ms': round(percentile(timings, 99), 2), 'max_ms': round(max(timings), 2),
+            'queries': max(queries), 'peak_memory_kb': round(max(peaks) / 1024) if max(peaks) else None,
+            'response_bytes': max(sizes)}
+
+@app.cli.command('bench')
+@click.option('--products', default=20000, show_default=True)
+@click.option('--suppliers', default=200, show_default=True)
+@click.option('--categories', default=50, show_default=True)
+@click.option('--lots-per-product', default=3, show_default=True)
+@click.option('--price-lists', default=3, show_default=True)
+@click.option('--import-rows', default=50000, show_default=True)
+@click.option('--repeat', default=10, show_default=True)
+@click.option('--only', default='', help='Scenari da eseguire, separati da virgola.')
+@click.option('--reuse', is_flag=True, help='Usa i dati già presenti invece di generarli.')
+@click.option('--memory/--no-memory', default=True, show_default=True,
+              help='Misura il picco di memoria con tracemalloc (rallenta le esecuzioni).')
+@click.option('--output', type=click.Path(dir_okay=False), help='Scrive il JSON su file.')
+def bench(products, suppliers, categories, lots_per_product, price_lists, import_rows, repeat, only, reuse, memory,
+          output):
+    """Genera un inventario sintetico ed esegue gli scenari di benchmark."""
+    upgrade_database(echo=lambda msg: None)
+    if not reuse:
+        if db.session.execute(select(func.count(Product.id))).scalar():
+            raise click.ClickException('Il database contiene già prodotti: usa un DATABASE_URL vuoto oppure --reuse.')
+        started = time.perf_counter()
+        with db.engine.begin() as conn:
+            seed_synthetic_data(conn, products=products, lots_per_product=lots_per_product, price_lists=price_lists,
+                                categories=categories, suppliers=suppliers)
+            bump_versions(conn, VERSIONED_TABLES)
+        seed_seconds = round(time.perf_counter() - started, 2)
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+        recompute_dashboard_stats()
+    else:
+        seed_seconds = None
+    report = {
+        'started_at': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+        'database': db.engine.dialect.name,
+        'memory_traced': memory,
+        'dataset': {'products': db.session.execute(select(func.count(Product.id))).scalar(),
+                    'lots': db.session.execute(select(func.count(Lot.id))).scalar(),
+                    'price_list_items': db.session.execute(select(func.count(PriceListItem.id))).scalar(),
+                    'seed_seconds': seed_seconds},
+        'scenarios': {},
+    }
+    wanted = {name.strip() for name in only.split(',') if name.strip()}
+    saved = {k: app.config.get(k) for k in ('LOGIN_DISABLED', 'TESTING', 'WTF_CSRF_ENABLED')}
+    app.config.update(LOGIN_DISABLED=True, TESTING=True, WTF_CSRF_ENABLED=False)
+    if memory:
+        tracemalloc.start()
+    try:
+        client = app.test_client()
+        for name, method, path, kwargs, setup, single in bench_scenarios(import_rows, report['dataset']['products']):
+            if wanted and name not in wanted:
+                continue
+            report['scenarios'][name] = run_bench_scenario(client, method, path, kwargs, setup, 1 if single else repeat)
+            click.echo(f"{name}: p50 {report['scenarios'][name]['p50_ms']} ms", err=True)
+    finally:
+        tracemalloc.stop()
+        app.config.update(saved)
+    payload = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(payload + '\n')
+    else:
+        print(payload)
+
+@app.cli.command('create-api-token')
+@click.argument('name')
+@click.option('--email', required=True, help="Utente per conto del quale opera il token.")
+def create_api_token_cmd(name, email):
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        raise click.ClickException(f'Utente {email} non trovato.')
+    if ApiToken.query.filter_by(name=name).first():
+        raise click.ClickException(f'Esiste già un token {name}.')
+    print(create_api_token(user, name))
+    click.echo('Conservare il token: non sarà più visualizzato.', err=True)
+
+@app.cli.command('revoke-api-token')
+@click.argument('name')
+def revoke_api_token_cmd(name):
+    token = ApiToken.query.filter_by(name=name, revoked_at=None).first()
+    if token is None:
+        raise click.ClickException(f'Token {name} non trovato.')
+    token.revoked_at = datetime.datetime.utcnow()
+    db.session.commit()
+    print(f'Token {name} revocato.')
+
+@app.cli.command('reorder')
+@click.option('--lead-days', default=None, type=int, help='Giorni alla prossima consegna (default REORDER_LEAD_DAYS).')
+@click.option('--factor', default=None, type=float, help='Riordino fino a scorta minima x fattore (default REORDER_FACTOR).')
+def reorder_cmd(lead_days, factor):
+    proposals, lines = build_purchase_proposals(lead_days, factor)
+    print(f'{proposals} proposte di acquisto create ({lines} prodotti da riordinare).')
+
+@app.cli.command('archive-lots')
+@click.option('--grace-days', default=None, type=int, help='Giorni dopo la scadenza (default LOT_ARCHIVE_GRACE_DAYS).')
+@click.option('--batch-size', default=None, type=int, help='Lotti per transazione (default LOT_ARCHIVE_BATCH).')
+@click.option('--dry-run', is_flag=True, help='Conta i lotti da archiviare senza spostarli.')
+def archive_lots_cmd(grace_days, batch_size, dry_run):
+    lots, qty = archive_lots(grace_days, batch_size, dry_run=dry_run)
+    if dry_run:
+        print(f'{lots} lotti da archiviare ({qty} unità scadute da scaricare).')
+    else:
+        print(f'{lots} lotti archiviati ({qty} unità scadute scaricate).')
+
+@app.cli.command('reconcile-stock')
+@click.option('--dry-run', is_flag=True, help='Conta le differenze senza correggerle.')
+def reconcile_stock_cmd(dry_run):
+    drift = reconcile_stock(dry_run=dry_run)
+    verb = 'da correggere' if dry_run else 'ricalcolati dai movimenti'
+    print(f"{drift['products']} prodotti e {drift['lots']} lotti {verb}.")
+
+@app.cli.command('snapshot-valuation')
+@click.option('--days', default=None, type=int, help='Finestra scadenze in giorni (default ANALYTICS_EXPIRING_DAYS).')
+def snapshot_valuation(days):
+    print(f'{take_valuation_snapshot(days=days)} righe di valorizzazione salvate.')
+
+@app.cli.command('prune-changes')
+@click.option('--keep-days', default=30, show_default=True)
+def prune_changes(keep_days):
+    print(f'{prune_change_log(keep_days)} modifiche eliminate dal change log.')
+
+@app.cli.command('recompute-stats')
+def recompute_stats():
+    recompute_dashboard_stats()
+    print('Contatori dashboard ricalcolati.')
+
+@app.cli.command('prerender-pdfs')
+def prerender_pdfs():
+    print(f'{prerender_pricelists()} listini PDF aggiornati.')
+
+@app.cli.command('run-worker')
+@click.option('--threads', default=int(os.getenv('WORKER_THREADS', '2')), show_default=True)
+@click.option('--poll', default=1.0, show_default=True, help='Secondi di attesa quando la coda è vuota.')
+@click.option('--once', is_flag=True, help='Esegue i job in coda e termina.')
+def run_worker(threads, poll, once):
+    requeued = requeue_stale_jobs()
+    if requeued:
+        print(f'{requeued} job bloccati rimessi in coda.')
+
+    def work():
+        with app.app_context():
+            while True:
+                job = claim_next_job()
+                if job is None:
+                    db.session.remove()
+                    if once:
+                        return
+                    time.sleep(poll)
+                    continue
+                run_job(job)
+                db.session.remove()
+
+    pool = [threading.Thread(target=work, name=f'worker-{i}', daemon=True) for i in range(threads)]
+    for t in pool:
+        t.start()
+    print(f'Worker avviato con {threads} thread.')
+    # a single timer puts back the jobs of workers that died since, not every idle thread
+    alive = pool
+    while alive:
+        alive[0].join(JOB_LEASE_SECONDS / 3)
+        alive = [t for t in pool if t.is_alive()]
+        if not alive:
+            break
+        try:
+            requeue_stale_jobs()
+        except Exception:
+            app.logger.exception('requeue of expired jobs failed')
+            db.session.rollback()
+        db.session.remove()
+
 # --- Filters ---
 @app.template_filter('fmtmoney')
 def fmtmoney(value):
@@ -729,3 +3820,10 @@ def fmtmoney(value):
         return f"{float(value):.2f}"
     except:
         return "0.00"
+
+# Creazione delle tabelle al primo avvio (le migrazioni restano a `flask db-upgrade`)
+with app.app_context():
+    try:
+        db.create_all()
+    except Exception as e:
+        app.logger.error(f"DB init error: {e}")
@@ -0,0 +1,24 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# the app reads DATABASE_URL at import time
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as inventory  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app():
+    inventory.app.config.update(TESTING=True, LOGIN_DISABLED=True, WTF_CSRF_ENABLED=False)
+    with inventory.app.app_context():
+        inventory.upgrade_database(echo=lambda *a: None)
+        yield inventory
+
+
+@pytest.fixture
+def client(app):
+    return app.app.test_client()
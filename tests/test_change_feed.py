@@ -0,0 +1,58 @@
+"""Change-log readers (/api/changes, the price matrix) must follow commit order, whatever order seq values were taken in."""
+from sqlalchemy import func, insert, select, update
+
+
+def current_cursor(client):
+    cursor = 0
+    while True:
+        feed = client.get(f'/api/changes?since={cursor}&limit=5000').get_json()
+        cursor = feed['next']
+        if not feed['has_more']:
+            return cursor
+
+
+def log_change(inv, seq, row_id):
+    # a transaction that took `seq` from the sequence and commits now
+    inv.db.session.execute(insert(inv.ChangeLog).values(seq=seq, entity='product', row_id=row_id, op='D'))
+    inv.db.session.commit()
+
+
+def test_late_commit_with_lower_seq_is_not_skipped(app, client):
+    inv = app
+    top = inv.db.session.execute(select(func.coalesce(func.max(inv.ChangeLog.seq), 0))).scalar()
+    log_change(inv, top + 100, 900001)
+    cursor = current_cursor(client)
+    log_change(inv, top + 50, 900002)  # Postgres: seq taken before top + 100, committed after it was read
+    feed = client.get(f'/api/changes?since={cursor}').get_json()
+    assert [(c['id'], c['op']) for c in feed['changes']] == [(900002, 'delete')]
+    assert feed['changes'][0]['seq'] == cursor + 1
+    assert client.get(f"/api/changes?since={feed['next']}").get_json()['changes'] == []
+
+
+def test_pruned_cursor_is_gone(app, client):
+    inv = app
+    cursor = current_cursor(client)
+    assert inv.prune_change_log(keep_days=-1) > 0  # everything but the newest row
+    log_change(inv, None, 900003)
+    assert client.get(f'/api/changes?since={cursor - 1}').status_code == 200
+    response = client.get(f'/api/changes?since={cursor - 2}')
+    assert response.status_code == 410
+    assert response.get_json()['resume'] == cursor + 1
+
+
+def test_price_matrix_replays_late_commit(app):
+    inv = app
+    product = inv.Product(sku='PMLATE', name='Prezzo tardivo', price=1)
+    inv.db.session.add(product)
+    inv.db.session.commit()
+    matrix = inv.PriceMatrix()
+    matrix.load()
+    top = inv.db.session.execute(select(func.max(inv.ChangeLog.seq))).scalar()
+    log_change(inv, top + 100, 900004)
+    matrix.refresh()
+    # the late transaction: new price plus its change_log row with the lower seq
+    inv.db.session.execute(update(inv.Product.__table__).where(inv.Product.id == product.id).values(price=2))
+    inv.db.session.execute(insert(inv.ChangeLog).values(seq=top + 50, entity='product', row_id=product.id, op='U'))
+    inv.db.session.commit()
+    matrix.refresh()
+    assert matrix.resolve(['PMLATE'])['PMLATE']['price'] == 2
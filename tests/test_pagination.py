@@ -0,0 +1,23 @@
+"""Keyset cursors come from the query string: tampered ones must not reach the database."""
+import pytest
+
+TAMPERED = [[{'a': 1}, 1], ['zz', 1], [5, 1], ['x', {'b': 2}], ['x', True], [None, 1], [[1], 1]]
+
+
+@pytest.fixture(scope='module')
+def product_id(app):
+    product = app.Product(sku='CURSOR1', name='Cursore')
+    product.lots = [app.Lot(lot_code='C1', qty=1)]
+    app.db.session.add(product)
+    app.db.session.commit()
+    return product.id
+
+
+@pytest.mark.parametrize('cursor', TAMPERED)
+@pytest.mark.parametrize('direction', ['after', 'before'])
+@pytest.mark.parametrize('url', ['/products', '/products?sort=price', '/products/{pid}/lots', '/suppliers'])
+def test_tampered_cursor_is_ignored(app, client, product_id, url, direction, cursor):
+    url = url.format(pid=product_id)
+    sep = '&' if '?' in url else '?'
+    response = client.get(f'{url}{sep}{direction}={app.encode_cursor(cursor)}')
+    assert response.status_code == 200
@@ -0,0 +1,84 @@
+"""Listing, export and report views must run a constant number of queries whatever the number of rows."""
+import contextlib
+import datetime
+
+import pytest
+from sqlalchemy import event
+
+ENDPOINTS = [
+    '/products?size=500',
+    '/products/export',
+    '/pricelists/{lid}/export',
+    '/pricelists/{lid}/export.pdf',
+    '/reports/expiring?days=3650',
+    '/reports/expiring.csv?days=3650',
+    '/reports/expiring.pdf?days=3650',
+]
+
+
+@contextlib.contextmanager
+def count_queries(engine):
+    # counted on the engine as well as X-Query-Count: streamed exports run their queries after the headers
+    count = [0]
+
+    def before_cursor_execute(*args):
+        count[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield count
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def add_catalog(inv, price_list, start, count):
+    today = datetime.date.today()
+    categories = [inv.Category(name=f'Categoria {start}-{i}') for i in range(3)]
+    suppliers = [inv.Supplier(name=f'Fornitore {start}-{i}') for i in range(3)]
+    inv.db.session.add_all(categories + suppliers)
+    for i in range(start, start + count):
+        product = inv.Product(sku=f'QC{i:05d}', name=f'Prodotto {i}', price=10, cost=5, stock_qty=4,
+                              category_ref=categories[i % 3], supplier_ref=suppliers[i % 3])
+        product.lots = [inv.Lot(lot_code=f'L{i}-{n}', qty=2, expiry_date=today + datetime.timedelta(days=10 + n))
+                        for n in range(2)]
+        product.prices = [inv.PriceListItem(price_list=price_list, price=9)]
+        inv.db.session.add(product)
+    inv.db.session.commit()
+
+
+def measure(inv, client, url):
+    # cold caches, so both sizes do the same work
+    inv.invalidate_report_cache()
+    inv._lookup_cache.clear()
+    with count_queries(inv.db.engine) as count:
+        response = client.get(url)
+        body = response.data
+    assert response.status_code == 200, url
+    assert body
+    return count[0], response.headers.get('X-Query-Count')
+
+
+@pytest.fixture(scope='module')
+def query_counts(app):
+    client = app.app.test_client()
+    price_list = app.PriceList(name='Listino query count', channel='Generale', currency='EUR')
+    app.db.session.add(price_list)
+    app.db.session.commit()
+    counts = []
+    for start, size in ((0, 3), (3, 40)):
+        add_catalog(app, price_list, start, size)
+        counts.append({url: measure(app, client, url.format(lid=price_list.id)) for url in ENDPOINTS})
+    return counts
+
+
+@pytest.mark.parametrize('url', ENDPOINTS)
+def test_query_count_does_not_grow_with_rows(query_counts, url):
+    small, large = query_counts
+    assert small[url][0] == large[url][0]
+
+
+def test_query_count_header(query_counts):
+    small, large = query_counts
+    url = '/products?size=500'
+    assert small[url][1] is not None
+    assert small[url][1] == large[url][1]
@@ -0,0 +1,16 @@
+"""Expiry report parameters come from the query string and are normalized, never trusted."""
+import pytest
+
+
+@pytest.mark.parametrize('url', ['/reports/expiring', '/reports/expiring.csv', '/reports/expiring.pdf'])
+@pytest.mark.parametrize('days, expected', [('abc', 30), ('', 30), ('-5', 0), ('99999999', 3650), ('7', 7)])
+def test_days_is_bounded(app, client, url, days, expected):
+    response = client.get(url, query_string={'days': days})
+    body = response.data
+    assert response.status_code == 200
+    if url.endswith('.pdf'):
+        assert f'report_scadenze_{expected}d.pdf' in response.headers['Content-Disposition']
+    elif url.endswith('.csv'):
+        assert f'expiring_{expected}d.csv' in response.headers['Content-Disposition']
+    else:
+        assert body
@@ -0,0 +1,31 @@
+"""Product search: word prefixes through the full-text index, codes also by substring."""
+import pytest
+
+
+@pytest.fixture(scope='module')
+def products(app):
+    rows = [app.Product(sku='AB-0123X', name='Olio extravergine'), app.Product(sku='A_C-77', name='Aceto balsamico')]
+    app.db.session.add_all(rows)
+    app.db.session.commit()
+    return {p.sku: p.id for p in rows}
+
+
+def search_ids(client, q):
+    response = client.get('/api/search', query_string={'q': q, 'type': 'product'})
+    assert response.status_code == 200
+    return {r['id']: r['score'] for r in response.get_json()['results']}
+
+
+def test_code_matches_inside_sku(app, client, products):
+    assert products['AB-0123X'] in search_ids(client, '123')
+    assert b'AB-0123X' in client.get('/products?q=123').data
+
+
+def test_like_wildcards_are_literal(app, client, products):
+    assert set(search_ids(client, 'A_C-7')) == {products['A_C-77']}
+    assert products['AB-0123X'] not in search_ids(client, '0_2')
+
+
+def test_words_keep_their_rank(app, client, products):
+    hits = search_ids(client, 'olio')
+    assert hits[products['AB-0123X']] != 0.0